@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# UniEmoji: ibus engine for unicode emoji and symbols by name
+#
+# Benchmarks for loading the tables and answering queries. Doesn't need ibus.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import gc
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+
+import uniemoji
+
+# Queries typed one keystroke at a time; every prefix is a query
+PREFIX_WORDS = (
+    'smile', 'heart', 'thumbs up', 'shrug', 'grinning', 'fire', 'party',
+    'cat', 'dog', 'flag', 'arrow', 'taco', 'eggplant', 'rocket', 'check',
+    'star', 'sun', 'moon', 'coffee', 'rainbow', 'euro', 'degree', 'skull',
+)
+
+TYPOS = (
+    'hrat', 'smiel', 'tco', 'grining', 'thmbs', 'rokcet', 'cofee', 'fier',
+    'partty', 'eggplnt', 'rainbwo', 'deegre', 'chek', 'heat eys', 'skul',
+)
+
+MULTI_WORD = (
+    'red heart', 'face with tears of joy', 'thumbs up sign', 'flag of japan',
+    'smiling face', 'heart eyes', 'left right arrow', 'man technologist',
+    'black star', 'cat face', 'rolling on the floor', 'face_with_tears',
+)
+
+ASCII = (
+    ':)', ':D', ':-D', ';)', ':(', ':P', ':-P', '<3', 'XD', ':O', 'O:)', ':-*',
+)
+
+def query_corpus():
+    '''Returns a dict from query class to a list of queries.'''
+    prefixes = []
+    for word in PREFIX_WORDS:
+        prefixes.extend(word[:i] for i in range(1, len(word) + 1))
+    return {
+        'prefix': prefixes,
+        'typo': list(TYPOS),
+        'multi_word': list(MULTI_WORD),
+        'ascii': list(ASCII),
+    }
+
+def percentile(sorted_values, p):
+    '''Nearest-rank percentile of an already sorted list.'''
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+def summarize(times):
+    times = sorted(times)
+    return {
+        'count': len(times),
+        'mean': sum(times) / len(times),
+        'p50': percentile(times, 50),
+        'p95': percentile(times, 95),
+        'p99': percentile(times, 99),
+        'max': times[-1],
+    }
+
+def bench_load(use_cache, runs):
+    totals = []
+    steps = {}
+    for _ in range(runs):
+        gc.collect()
+        start = time.perf_counter()
+        ue = uniemoji.UniEmoji(use_cache=use_cache)
+        totals.append(time.perf_counter() - start)
+        for step, seconds in ue.load_times.items():
+            steps.setdefault(step, []).append(seconds)
+        del ue
+
+    # Measured separately, as tracing slows everything down
+    gc.collect()
+    tracemalloc.start()
+    ue = uniemoji.UniEmoji(use_cache=use_cache)
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'total': summarize(totals),
+        'steps': {step: min(seconds) for step, seconds in steps.items()},
+        'memory': current,
+        'peak_memory': peak,
+    }
+
+def bench_queries(ue, corpus, repeat):
+    # Every query is searched, except in the "cached" class
+    cache_size = ue.result_cache.maxsize
+    ue.result_cache.maxsize = 0
+    ue.result_cache.clear()
+
+    results = {}
+    for query_class, queries in corpus.items():
+        times = []
+        for _ in range(repeat):
+            for query in queries:
+                start = time.perf_counter()
+                ue.find_characters(query)
+                times.append(time.perf_counter() - start)
+        results[query_class] = summarize(times)
+
+    # The same keystrokes through a session, as the ibus engine does
+    times = []
+    for _ in range(repeat):
+        for word in PREFIX_WORDS:
+            session = ue.new_session()
+            for i in range(1, len(word) + 1):
+                start = time.perf_counter()
+                session.find_characters(word[:i])
+                times.append(time.perf_counter() - start)
+    results['prefix_session'] = summarize(times)
+
+    # Queries answered from the result cache, after the first round
+    ue.result_cache.maxsize = cache_size
+    times = []
+    for _ in range(repeat + 1):
+        for query in corpus['prefix']:
+            start = time.perf_counter()
+            ue.find_characters(query)
+            times.append(time.perf_counter() - start)
+    results['cached'] = summarize(times[len(corpus['prefix']):])
+    return results
+
+def print_results(results, baseline=None):
+    def ms(value):
+        return '{:9.2f}'.format(value * 1000) if value is not None else '        -'
+
+    def line(label, value, old_value):
+        text = '  {:<24} {} ms'.format(label, ms(value))
+        if old_value:
+            text += '  (was {} ms, {:+.0%})'.format(ms(old_value).strip(), value / old_value - 1)
+        print(text)
+
+    for kind in ('cold_load', 'warm_load'):
+        data = results[kind]
+        old = baseline.get(kind) if baseline else None
+        print('{} (memory {:.1f} MB, peak {:.1f} MB)'.format(
+            kind, data['memory'] / 1e6, data['peak_memory'] / 1e6))
+        line('total (p50)', data['total']['p50'], old and old['total']['p50'])
+        for step, seconds in data['steps'].items():
+            line(step, seconds, old and old['steps'].get(step))
+
+    print('queries')
+    for query_class, data in results['queries'].items():
+        old = baseline and baseline['queries'].get(query_class)
+        for p in ('p50', 'p95', 'p99'):
+            line('{} {}'.format(query_class, p), data[p], old and old[p])
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark UniEmoji loading and queries.')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='number of times the tables are loaded (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of times the query corpus is replayed (default: %(default)s)')
+    parser.add_argument('--corpus', metavar='FILE',
+                        help='extra queries, one per line, reported as the "custom" class')
+    parser.add_argument('--save', metavar='FILE', help='save the results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare with results saved by --save')
+    args = parser.parse_args()
+
+    uniemoji.debug_on = False
+
+    corpus = query_corpus()
+    if args.corpus:
+        with open(args.corpus, encoding='utf-8') as f:
+            corpus['custom'] = [line.rstrip('\n') for line in f if line.strip()]
+
+    results = {
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'cold_load': bench_load(False, args.runs),
+    }
+    # Make sure the cache is up to date before timing loads from it
+    ue = uniemoji.UniEmoji()
+    # Levenshtein is only imported once the tables are loaded
+    results['levenshtein'] = uniemoji.Levenshtein is not None
+    results['warm_load'] = bench_load(True, args.runs)
+    results['queries'] = bench_queries(ue, corpus, args.repeat)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
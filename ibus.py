@@ -28,18 +28,67 @@ from gi.repository import GObject
 
 import os
 import sys
+import time
+import queue
 import getopt
 import locale
+import threading
 
-from uniemoji import UniEmoji
+import uniemoji
+from uniemoji import UniEmoji, UsageStore, Stats, SearchCancelled
 
 __base_dir__ = os.path.dirname(__file__)
 
-debug_on = True
+# Set UNIEMOJI_DEBUG to see what's going on
+debug_on = bool(os.environ.get('UNIEMOJI_DEBUG'))
 def debug(*a, **kw):
     if debug_on:
         print(*a, **kw)
 
+# Searches taking longer than this (in seconds) show the best results found so far
+SEARCH_DEADLINE = 0.25
+
+# Set UNIEMOJI_STATS to a file name to have the timings of every step of
+# each keystroke written there (see uniemoji.Stats), every
+# STATS_DUMP_INTERVAL searches and when an engine is destroyed
+STATS_FILE = os.environ.get('UNIEMOJI_STATS')
+STATS_DUMP_INTERVAL = 50
+stats = Stats() if STATS_FILE else None
+
+# The tables shared by every engine in this process. IMApp starts loading
+# them in the background as soon as it starts; engines wait for them on
+# their search thread, so keys typed meanwhile just queue up their search.
+_uniemoji = None
+_uniemoji_loaded = threading.Event()
+_uniemoji_lock = threading.Lock()
+_uniemoji_loading = False
+
+def preload_uniemoji():
+    '''Starts loading the shared tables in the background, unless it's already started.'''
+    global _uniemoji_loading
+    with _uniemoji_lock:
+        if _uniemoji_loading:
+            return
+        _uniemoji_loading = True
+    threading.Thread(target=_load_uniemoji, daemon=True).start()
+
+def _load_uniemoji():
+    global _uniemoji
+    try:
+        ue = UniEmoji(lazy=True, shared=True)
+        ue.usage = UsageStore()
+        ue.stats = stats
+        ue.watch_custom_files()
+        _uniemoji = ue
+    finally:
+        _uniemoji_loaded.set()
+
+def shared_uniemoji():
+    '''Returns the shared tables, waiting for them to load. Returns None if they failed to.'''
+    preload_uniemoji()
+    _uniemoji_loaded.wait()
+    return _uniemoji
+
 # gee thank you IBus :-)
 num_keys = []
 for n in range(1, 10):
@@ -53,6 +102,10 @@ for n in range(1, 10):
 numpad_keys.append(getattr(IBus, 'KP_0'))
 del n
 
+# Stands for the candidates outside of the page being shown, which are
+# never displayed, so that the lookup table still has the right size
+PLACEHOLDER_TEXT = IBus.Text.new_from_string('')
+
 ###########################################################################
 # the engine
 class UniEmojiIBusEngine(IBus.Engine):
@@ -60,11 +113,30 @@ class UniEmojiIBusEngine(IBus.Engine):
 
     def __init__(self):
         super(UniEmojiIBusEngine, self).__init__()
-        self.uniemoji = UniEmoji()
+        # The shared tables, and the session, are set by the search thread
+        # once the tables are loaded
+        preload_uniemoji()
+        self.uniemoji = None
+        self.session = None
         self.is_invalidate = False
         self.preedit_string = ''
         self.lookup_table = IBus.LookupTable.new(10, 0, True, True)
         self.prop_list = IBus.PropList()
+        # The search results, the IBus.Text made for each one shown so far,
+        # and the first candidate of the page filled in the lookup table
+        self.candidates = []
+        self.candidate_texts = {}
+        self.filled_page = None
+
+        # Searches run on a worker thread. Each request is tagged with the
+        # generation it was made in; a newer request cancels older ones.
+        # shown_generation is the one of the candidates in the lookup table.
+        self.search_generation = 0
+        self.shown_generation = 0
+        self.search_count = 0
+        self.search_queue = queue.Queue()
+        self.search_thread = threading.Thread(target=self._search_worker, daemon=True)
+        self.search_thread.start()
 
         debug("Create UniEmoji engine OK")
 
@@ -79,7 +151,7 @@ class UniEmojiIBusEngine(IBus.Engine):
         page, pos_in_page = divmod(self.lookup_table.get_cursor_pos(),
                                    page_size)
         new_pos = page * page_size + index
-        if new_pos > self.lookup_table.get_number_of_candidates():
+        if new_pos >= self.lookup_table.get_number_of_candidates():
             return False
         self.lookup_table.set_cursor_pos(new_pos)
         return True
@@ -89,7 +161,17 @@ class UniEmojiIBusEngine(IBus.Engine):
             self.commit_candidate()
 
     def do_process_key_event(self, keyval, keycode, state):
-        debug("process_key_event(%04x, %04x, %04x)" % (keyval, keycode, state))
+        if stats is None:
+            return self._process_key_event(keyval, keycode, state)
+        start = time.perf_counter()
+        try:
+            return self._process_key_event(keyval, keycode, state)
+        finally:
+            stats.time('key_event', time.perf_counter() - start)
+
+    def _process_key_event(self, keyval, keycode, state):
+        if debug_on:
+            debug("process_key_event(%04x, %04x, %04x)" % (keyval, keycode, state))
 
         # ignore key release events
         is_press = ((state & IBus.ModifierType.RELEASE_MASK) == 0)
@@ -98,6 +180,7 @@ class UniEmojiIBusEngine(IBus.Engine):
 
         if self.preedit_string:
             if keyval in (IBus.Return, IBus.KP_Enter):
+                self._show_current_candidates()
                 if self.lookup_table.get_number_of_candidates() > 0:
                     self.commit_candidate()
                 else:
@@ -113,12 +196,14 @@ class UniEmojiIBusEngine(IBus.Engine):
                 return True
             elif keyval in num_keys:
                 index = num_keys.index(keyval)
+                self._show_current_candidates()
                 if self.set_lookup_table_cursor_pos_in_current_page(index):
                     self.commit_candidate()
                     return True
                 return False
             elif keyval in numpad_keys:
                 index = numpad_keys.index(keyval)
+                self._show_current_candidates()
                 if self.set_lookup_table_cursor_pos_in_current_page(index):
                     self.commit_candidate()
                     return True
@@ -154,11 +239,20 @@ class UniEmojiIBusEngine(IBus.Engine):
 
         return False
 
+    def data_updated(self):
+        # Called from the loading thread
+        GLib.idle_add(self._refresh_candidates)
+
+    def _refresh_candidates(self):
+        if self.preedit_string:
+            self.invalidate()
+        return False
+
     def invalidate(self):
         if self.is_invalidate:
             return
         self.is_invalidate = True
-        GLib.idle_add(self.update_candidates)
+        GLib.idle_add(self.update_candidates, time.perf_counter())
 
 
     def page_up(self):
@@ -188,23 +282,132 @@ class UniEmojiIBusEngine(IBus.Engine):
     def commit_string(self, text):
         self.commit_text(IBus.Text.new_from_string(text))
         self.preedit_string = ''
+        self._reset_session()
         self.update_candidates()
 
+    def _reset_session(self):
+        session = self.session
+        if session is not None:
+            session.reset()
+
     def commit_candidate(self):
-        self.commit_string(self.candidates[self.lookup_table.get_cursor_pos()])
+        text = self.candidates.sequence(self.lookup_table.get_cursor_pos())
+        self.uniemoji.usage.record(text)
+        self.commit_string(text)
+
+    def update_candidates(self, invalidated=None):
+        now = time.perf_counter()
+        if stats is not None and invalidated is not None:
+            stats.time('idle_delay', now - invalidated)
+        self.search_generation += 1
+        self._update_preedit()
+        if self.preedit_string:
+            self.search_queue.put((self.search_generation, self.preedit_string, now))
+        else:
+            self._show_candidates(self.search_generation, [])
+        self.is_invalidate = False
+
+    def _show_current_candidates(self):
+        '''Searches for the current preedit right away, unless its candidates are already shown.
+
+        Otherwise, committing a candidate while the search for the last
+        keys typed is pending would commit one of the previous preedit's
+        candidates. If the worker is already running that search, this waits
+        for it, and the session returns its results.
+        '''
+        if not self.is_invalidate and self.shown_generation == self.search_generation:
+            return
+        session = self.session
+        if session is None:
+            # The tables aren't loaded yet
+            return
+        if self.is_invalidate:
+            # The update is still waiting for the main loop to be idle
+            self.search_generation += 1
+            self._update_preedit()
+            self.is_invalidate = False
+        generation = self.search_generation
+        results = session.find_characters(self.preedit_string, deadline=time.monotonic() + SEARCH_DEADLINE)
+        self._show_candidates(generation, results)
+
+    def _search_worker(self):
+        ue = shared_uniemoji()
+        if ue is None:
+            debug('No emoji data, searches are disabled')
+            return
+        ue.update_callbacks.append(self.data_updated)
+        self.session = ue.new_session()
+        self.uniemoji = ue
+        try:
+            self._search_loop()
+        finally:
+            ue.update_callbacks.remove(self.data_updated)
+
+    def _search_loop(self):
+        while True:
+            request = self.search_queue.get()
+            # Only the latest request matters
+            try:
+                while True:
+                    request = self.search_queue.get_nowait()
+            except queue.Empty:
+                pass
+            if request is None:
+                return
+
+            generation, query, requested = request
+            if generation != self.search_generation:
+                continue
+            if stats is not None:
+                start = time.perf_counter()
+                stats.time('queue_wait', start - requested)
+            try:
+                results = self.session.find_characters(
+                    query,
+                    deadline=time.monotonic() + SEARCH_DEADLINE,
+                    cancelled=lambda: generation != self.search_generation)
+            except SearchCancelled:
+                continue
+            if stats is not None:
+                stats.time('search', time.perf_counter() - start)
+            GLib.idle_add(self._show_candidates, generation, results, requested, time.perf_counter())
+            if stats is not None:
+                self.search_count += 1
+                if self.search_count % STATS_DUMP_INTERVAL == 0:
+                    # On its own thread, so that neither these results nor
+                    # the next search wait for the file to be written
+                    threading.Thread(target=self._dump_stats, daemon=True).start()
+
+    def _show_candidates(self, generation, results, requested=None, posted=None):
+        # Results for an outdated preedit are dropped
+        if generation != self.search_generation:
+            return False
+
+        if stats is not None and posted is not None:
+            start = time.perf_counter()
+            stats.time('show_delay', start - posted)
+        self.shown_generation = generation
+        self.candidates = results
+        self.candidate_texts = {}
+        self._fill_lookup_table(0)
+        self._update_lookup_table()
+        if stats is not None and posted is not None:
+            now = time.perf_counter()
+            stats.time('lookup_table', now - start)
+            # From the search request to the candidates being shown
+            stats.time('keystroke', now - requested)
+            stats.count('candidates', len(results))
+        return False
+
+    def _dump_stats(self):
+        try:
+            stats.dump(STATS_FILE)
+        except OSError:
+            debug('Failed to write stats to {}: {}'.format(STATS_FILE, sys.exc_info()[1]))
 
-    def update_candidates(self):
+    def _update_preedit(self):
         preedit_len = len(self.preedit_string)
         attrs = IBus.AttrList()
-        self.lookup_table.clear()
-        self.candidates = []
-
-        if preedit_len > 0:
-            uniemoji_results = self.uniemoji.find_characters(self.preedit_string)
-            for char_sequence, display_str in uniemoji_results:
-                candidate = IBus.Text.new_from_string(display_str)
-                self.candidates.append(char_sequence)
-                self.lookup_table.append_candidate(candidate)
 
         text = IBus.Text.new_from_string(self.preedit_string)
         text.set_attributes(attrs)
@@ -215,13 +418,42 @@ class UniEmojiIBusEngine(IBus.Engine):
         text = IBus.Text.new_from_string(self.preedit_string)
         text.set_attributes(attrs)
         self.update_preedit_text(text, preedit_len, preedit_len > 0)
-        self._update_lookup_table()
-        self.is_invalidate = False
+
+    def _fill_lookup_table(self, cursor_pos):
+        '''Refills the lookup table, with the real candidates only on the page of cursor_pos.
+
+        Their display strings and IBus.Text objects are only made then.
+        '''
+        page_size = self.lookup_table.get_page_size()
+        page_start = cursor_pos - cursor_pos % page_size
+        page_end = page_start + page_size
+        self.lookup_table.clear()
+        for i in range(len(self.candidates)):
+            if page_start <= i < page_end:
+                text = self.candidate_texts.get(i)
+                if text is None:
+                    text = self.candidate_texts[i] = IBus.Text.new_from_string(self.candidates[i][1])
+                self.lookup_table.append_candidate(text)
+            else:
+                self.lookup_table.append_candidate(PLACEHOLDER_TEXT)
+        if cursor_pos:
+            self.lookup_table.set_cursor_pos(cursor_pos)
+        self.filled_page = page_start
 
     def _update_lookup_table(self):
+        cursor_pos = self.lookup_table.get_cursor_pos()
+        if cursor_pos - cursor_pos % self.lookup_table.get_page_size() != self.filled_page:
+            # Moved to another page
+            self._fill_lookup_table(cursor_pos)
         visible = self.lookup_table.get_number_of_candidates() > 0
         self.update_lookup_table(self.lookup_table, visible)
 
+    def do_destroy(self):
+        self.search_queue.put(None)
+        if stats is not None:
+            self._dump_stats()
+        IBus.Engine.do_destroy(self)
+
     def do_focus_in(self):
         debug("focus_in")
         self.register_properties(self.prop_list)
@@ -233,6 +465,7 @@ class UniEmojiIBusEngine(IBus.Engine):
     def do_reset(self):
         debug("reset")
         self.preedit_string = ''
+        self._reset_session()
 
     def do_property_activate(self, prop_name):
         debug("PropertyActivate(%s)" % prop_name)
@@ -256,6 +489,10 @@ class IMApp:
         if not exec_by_ibus:
             global debug_on
             debug_on = True
+            uniemoji.debug_on = True
+        # Before registering with ibus, so the tables are likely ready by
+        # the time an engine is created
+        preload_uniemoji()
         self.mainloop = GLib.MainLoop()
         self.bus = IBus.Bus()
         self.bus.connect("disconnected", self.bus_disconnected_cb)
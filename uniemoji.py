@@ -20,16 +20,34 @@
 
 import os
 import re
+import heapq
+import bisect
 import sys
 import json
-from collections import Counter, defaultdict
+import mmap
+import array
+import pickle
+import zlib
+import queue
+import contextlib
+import multiprocessing
+import socket
+import socketserver
+import stat
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict, deque
+from collections.abc import Mapping, Sequence
 
 from difflib import SequenceMatcher
 
-try:
-    import Levenshtein
-except ImportError:
-    Levenshtein = None
+# Optional modules, imported by _import_optional_modules when the tables are
+# loaded, so that a client only sending queries to a server doesn't pay for them
+Levenshtein = None
+numpy = None
+inotify_simple = None
+_optional_modules_imported = False
 
 try:
     import xdg
@@ -44,11 +62,32 @@ try:
 except ImportError:
     SYS_CONF_DIR = '/etc'
 
-debug_on = True
+# Set UNIEMOJI_DEBUG to see what's going on
+debug_on = bool(os.environ.get('UNIEMOJI_DEBUG'))
 def debug(*a, **kw):
     if debug_on:
         print(*a, **kw)
 
+def _import_optional_modules():
+    '''Imports Levenshtein, NumPy and inotify_simple, leaving None for those
+    that aren't installed. Only the first call does anything.'''
+    global Levenshtein, numpy, inotify_simple, _optional_modules_imported
+    if _optional_modules_imported:
+        return
+    _optional_modules_imported = True
+    try:
+        import Levenshtein
+    except ImportError:
+        Levenshtein = None
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    try:
+        import inotify_simple
+    except ImportError:
+        inotify_simple = None
+
 __base_dir__ = os.path.dirname(__file__)
 
 VALID_CATEGORIES = (
@@ -115,20 +154,363 @@ VALID_RANGES = (
     (0x1f900, 0x1f9ff), # Supplemental Symbols and Pictographs
 )
 
+def _merge_ranges(ranges):
+    '''Returns the sorted starts and ends of the union of the (first, last) ranges.'''
+    starts = []
+    ends = []
+    for first, last in sorted(ranges):
+        if ends and first <= ends[-1] + 1:
+            ends[-1] = max(ends[-1], last)
+        else:
+            starts.append(first)
+            ends.append(last)
+    return starts, ends
+
+# VALID_RANGES merged, as some of them overlap, to be searched with a bisect
+_VALID_RANGE_STARTS, _VALID_RANGE_ENDS = _merge_ranges(VALID_RANGES)
+_VALID_CATEGORIES = frozenset(VALID_CATEGORIES)
+
 def in_range(code):
-    return any(x <= code <= y for x,y in VALID_RANGES)
+    '''Whether code is in one of the VALID_RANGES.'''
+    i = bisect.bisect_right(_VALID_RANGE_STARTS, code) - 1
+    return i >= 0 and code <= _VALID_RANGE_ENDS[i]
+
+def is_valid_symbol(code, category):
+    '''Whether the character with this code point and general category is
+    one of the symbols we index (in VALID_CATEGORIES and VALID_RANGES).
+    '''
+    return category in _VALID_CATEGORIES and in_range(code)
 
 if xdg:
     SETTINGS_DIRS = list(xdg.BaseDirectory.load_config_paths('uniemoji'))
+    CACHE_DIR = os.path.join(xdg.BaseDirectory.xdg_cache_home, 'uniemoji')
+    DATA_DIR = os.path.join(xdg.BaseDirectory.xdg_data_home, 'uniemoji')
 else:
     SETTINGS_DIRS = [d for d in [os.path.expanduser('~/.config/uniemoji'), '{}/xdg/uniemoji'.format(SYS_CONF_DIR)]
                      if os.path.isdir(d)]
+    CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'uniemoji')
+    DATA_DIR = os.path.join(os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share'), 'uniemoji')
+
+# Bump whenever the loading code changes in a way that affects the cached tables
+CACHE_VERSION = 2
+CACHE_FILENAME = 'index.pickle'
+MAPPED_INDEX_FILENAME = 'index.map'
+USAGE_FILENAME = 'usage.log'
+
+SOURCE_FILES = (
+    os.path.join(__base_dir__, 'unicode', 'emoji-sequences.txt'),
+    os.path.join(__base_dir__, 'unicode', 'UnicodeData.txt'),
+    os.path.join(__base_dir__, 'joypixels_emoji.json'),
+    os.path.join(__base_dir__, 'unicode', 'emoji-zwj-sequences.txt'),
+)
+
+# The index of the source files built when installing (see --write-index),
+# installed next to them
+BUNDLED_INDEX = os.path.join(__base_dir__, MAPPED_INDEX_FILENAME)
 
 ###########################################################################
 CANDIDATE_UNICODE = 0
 CANDIDATE_ALIAS = 1
 
+# Maximum number of names scored by the (slow) fuzzy search for each query.
+# None scores every name that passes the prefilter.
+FUZZY_CANDIDATE_LIMIT = 2000
+
+# How often the custom files are checked for changes without inotify, in seconds
+CUSTOM_POLL_INTERVAL = 2
+
+# The number of queries whose results are remembered by find_characters
+RESULT_CACHE_SIZE = 256
+
+# Where the query server (uniemoji.py --serve) listens
+SOCKET_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or CACHE_DIR, 'uniemoji.sock')
+
+def _is_subsequence(query, s):
+    it = iter(s)
+    return all(c in it for c in query)
+
+def _char_mask(s):
+    mask = 0
+    for c in s:
+        mask |= 1 << (ord(c) & 63)
+    return mask
+
+_WORD_RE = re.compile(r'\w+')
+
+def _word_boundaries(s):
+    '''Returns a bit mask of the offsets of s at a word boundary (\\b).'''
+    boundaries = 0
+    for m in _WORD_RE.finditer(s):
+        boundaries |= 1 << m.start() | 1 << m.end()
+    return boundaries
+
+def _word_match_bonus(word, s, boundaries):
+    '''Returns 20 if word is one of the words in s, 10 if it starts one, else 0.
+
+    boundaries is the result of _word_boundaries(s). Like the \\b regex
+    assertion, word boundaries are the offsets between a word character and
+    a non-word one, so a word can contain non-word characters.
+    '''
+    bonus = 0
+    end = len(word)
+    ix = s.find(word)
+    while ix != -1:
+        if boundaries >> ix & 1:
+            if boundaries >> (ix + end) & 1:
+                return 20
+            bonus = 10
+        ix = s.find(word, ix + 1)
+    return bonus
+
+class SearchCancelled(Exception):
+    pass
+
+def _interruption_check(deadline, cancelled):
+    '''Returns a function telling whether a search should stop early.
+
+    The function raises SearchCancelled if cancelled() returns True, and
+    returns True once the deadline (a time.monotonic() value) has passed.
+    '''
+    if deadline is None and cancelled is None:
+        return None
+    def interrupted():
+        if cancelled is not None and cancelled():
+            raise SearchCancelled()
+        return deadline is not None and time.monotonic() > deadline
+    return interrupted
+
+class ResultCache(object):
+    '''Least recently used cache of query results.
+
+    Every entry is tied to a state (see UniEmoji._result_cache_state); the
+    whole cache is cleared when the state changes. Setting maxsize to 0
+    disables it. Results are returned as stored, so they must not be
+    modified.
+    '''
+    def __init__(self, maxsize=RESULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.state = None
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, state):
+        if state != self.state:
+            self.entries.clear()
+            self.state = state
+        results = self.entries.get(key)
+        if results is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return results
+
+    def put(self, key, state, results):
+        if self.maxsize <= 0 or state != self.state:
+            return
+        self.entries[key] = results
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+class Stats(object):
+    '''Rolling timings and counts of the steps of each search.
+
+    The last `window` values of every step are kept. summary() describes
+    them with percentiles and a histogram, and dump() writes that to a
+    JSON file. Recording is cheap, but callers should skip the timing
+    altogether when they have no Stats.
+    '''
+    # Upper bounds of the histogram buckets, in milliseconds for timings
+    TIME_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+    COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000)
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.timings = {}
+        self.counts = {}
+
+    def _samples(self, table, name):
+        samples = table.get(name)
+        if samples is None:
+            samples = table.setdefault(name, deque(maxlen=self.window))
+        return samples
+
+    def time(self, step, seconds):
+        self._samples(self.timings, step).append(seconds * 1000)
+
+    def count(self, name, value):
+        self._samples(self.counts, name).append(value)
+
+    @staticmethod
+    def _describe(values, buckets):
+        values.sort()
+        def percentile(p):
+            return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+        histogram = {}
+        i = 0
+        for bound in buckets:
+            start = i
+            while i < len(values) and values[i] <= bound:
+                i += 1
+            histogram['<={}'.format(bound)] = i - start
+        histogram['>{}'.format(buckets[-1])] = len(values) - i
+        return {
+            'samples': len(values),
+            'mean': sum(values) / len(values),
+            'p50': percentile(50),
+            'p90': percentile(90),
+            'p99': percentile(99),
+            'max': values[-1],
+            'histogram': histogram,
+        }
+
+    def summary(self):
+        return {
+            'timings_ms': {step: self._describe(list(samples), self.TIME_BUCKETS)
+                           for step, samples in list(self.timings.items()) if samples},
+            'counts': {name: self._describe(list(samples), self.COUNT_BUCKETS)
+                       for name, samples in list(self.counts.items()) if samples},
+        }
+
+    def dump(self, filename):
+        '''Writes the summary to filename, replacing it atomically.'''
+        fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or '.', prefix='.stats-')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.summary(), f, indent=2, sort_keys=True)
+            os.replace(temp_filename, filename)
+        except BaseException:
+            os.unlink(temp_filename)
+            raise
+
+def _match_sort_key(match):
+    match_type, score, name, candidate_type = match
+    return (-match_type, -score, len(name), name, candidate_type)
+
+def _ranked(matches):
+    '''Yields the matches in _match_sort_key order, only sorting as many as are taken.'''
+    heap = [(_match_sort_key(match), match) for match in matches]
+    heapq.heapify(heap)
+    while heap:
+        yield heapq.heappop(heap)[1]
+
+def _fuzzy_score(query, candidate, candidate_lowercase):
+    # Levenshtein distance
+    score = 0
+    if Levenshtein is None:
+        opcodes = SequenceMatcher(None, query, candidate_lowercase,
+            autojunk=False).get_opcodes()
+    else:
+        opcodes = Levenshtein.opcodes(query, candidate_lowercase)
+    for (tag, i1, i2, j1, j2) in opcodes:
+        if tag in ('replace', 'delete'):
+            return 0
+        if tag == 'insert':
+            score -= 1
+        if tag == 'equal':
+            score += i2 - i1
+            # favor word boundaries
+            if j1 == 0:
+                score += 2
+            elif candidate[j1 - 1] == ' ':
+                score += 1
+            if j2 == len(candidate):
+                score += 2
+            elif [j2] == ' ':
+                score += 1
+    return score
+
+
+# How the display string of a result is made, see SearchResults
+DESCRIBE_ASCII = 0
+DESCRIBE_NAME = 1
+DESCRIBE_ALIAS = 2
+
+class SearchResults(Sequence):
+    '''The results of a search, as (character sequence, display string) pairs.
+
+    Only the character sequences are stored; a display string is formatted
+    the first time its result is accessed, since the lookup table only shows
+    a page of the results at a time. The tables used for that are the ones
+    the search was done with.
+    '''
+    def __init__(self, unicode_chars_to_names, unicode_chars_to_shortnames, has_text_representation):
+        self.unicode_chars_to_names = unicode_chars_to_names
+        self.unicode_chars_to_shortnames = unicode_chars_to_shortnames
+        self.has_text_representation = has_text_representation
+        # (sequence, how, name, argument, described sequence); the text
+        # representation of an emoji is described like the emoji
+        self.entries = []
+        self.displays = {}
+
+    def append(self, sequence, how, name, argument=None):
+        self.entries.append((sequence, how, name, argument, sequence))
+        if sequence.endswith('\ufe0f'):
+            text_repr = self.has_text_representation.get(sequence)
+            if text_repr:
+                self.entries.append((text_repr, how, name, argument, sequence))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def sequence(self, i):
+        '''The character sequence of result i, without formatting its display string.'''
+        return self.entries[i][0]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self.entries)))]
+        if i < 0:
+            i += len(self.entries)
+        sequence = self.entries[i][0]
+        display = self.displays.get(i)
+        if display is None:
+            display = self.displays[i] = self._display(*self.entries[i])
+        return sequence, display
+
+    def __eq__(self, other):
+        if isinstance(other, Sequence) and not isinstance(other, str):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def _display(self, sequence, how, name, argument, described):
+        if how == DESCRIBE_ASCII:
+            # The argument is the query
+            description = '{} [{}]'.format(name, argument)
+        elif how == DESCRIBE_NAME:
+            # The argument is whether the name comes from EmojiOne
+            description = None
+            if argument:
+                unicode_name = self.unicode_chars_to_names.get(described)
+                if unicode_name and unicode_name != name:
+                    description = ':{}: {}'.format(name.replace(' ', '_'), unicode_name)
+            if description is None:
+                shortname = self.unicode_chars_to_shortnames.get(described, '')
+                if shortname:
+                    shortname = ':' + shortname + ': '
+                description = '{}{}'.format(shortname, name)
+        else:
+            unicode_name = self.unicode_chars_to_names.get(described)
+            shortname = self.unicode_chars_to_shortnames.get(described, '')
+            if shortname:
+                shortname = ':' + shortname + ': '
+            description = '{}{} [{}]'.format(shortname, unicode_name, name)
+        if sequence != described:
+            return '{}: {} (text)'.format(sequence, description)
+        return '{}: {}'.format(sequence, description)
+
+
 class UniEmojiChar(object):
+    __slots__ = ('unicode_str', 'aliasing', 'is_emojione', 'is_custom')
+
     def __init__(self, unicode_str=None, is_emojione=False, is_custom=False):
         self.unicode_str = unicode_str
         self.aliasing = []
@@ -143,9 +525,811 @@ class UniEmojiChar(object):
             self.aliasing)
 
 
-class UniEmoji():
-    def __init__(self):
+###########################################################################
+# Memory-mapped index
+#
+# A read-only file holding the tables and search indexes, which engine
+# processes map and query directly, sharing the same pages.
+#
+# The file starts with MAPPED_INDEX_MAGIC, the length of a JSON header
+# (4 bytes, little endian) and the header itself. The header holds the cache
+# key the index was built for, and the offset, length and type of every
+# section. Sections are arrays of integers, aligned to 8 bytes.
+# Strings are stored once, in a pool, and are referred to by their index
+# in it. Mappings are stored as sorted keys and parallel values, plus an
+# open-addressing hash table of key positions (using CRC-32, which unlike
+# hash() is the same in every process).
+
+MAPPED_INDEX_MAGIC = b'UNIEMOJI'
+MAPPED_INDEX_VERSION = 3
+
+_NO_STRING = 0xffffffff
+_FLAG_EMOJIONE = 1
+_FLAG_CUSTOM = 2
+
+# Tables that are stored as mappings from strings to strings,
+# mappings from strings to tuples of strings, and lists of strings
+_MAPPED_STR_DICTS = ('unicode_chars_to_names', 'unicode_chars_to_shortnames', 'ascii_table',
+                     'reverse_ascii_table', 'has_text_representation')
+_MAPPED_TUPLE_DICTS = ('mixed_case_names', 'word_index')
+_MAPPED_STR_LISTS = ('word_suffixes', 'word_suffix_words', 'fuzzy_names', 'fuzzy_lowercase_names')
+# The arrays and the mappings from strings to lists of positions returned by
+# vector_arrays(), stored with a 'vector_' prefix
+_MAPPED_VECTOR_ARRAYS = ('codes', 'offsets', 'boundaries', 'has_unicode', 'has_alias')
+_MAPPED_VECTOR_POSITIONS = ('unicode_positions', 'alias_positions')
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+def _string_hash(s):
+    return zlib.crc32(s.encode('utf-8', 'surrogatepass'))
+
+def _file_checksum(filename):
+    '''Returns the CRC-32 of the contents of filename.'''
+    checksum = 0
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            checksum = zlib.crc32(chunk, checksum)
+    return checksum
+
+def _json_key(key):
+    # The key as it reads back from the header
+    return json.loads(json.dumps(key))
+
+def write_mapped_index(ue, filename, cache_key):
+    '''Writes the tables and indexes of the UniEmoji instance ue to filename.
+
+    The file is replaced atomically, so processes that mapped the previous
+    version keep using it safely.
+    '''
+    pool = {}
+    pool_data = []
+    def string_id(s):
+        i = pool.get(s)
+        if i is None:
+            i = pool[s] = len(pool_data)
+            pool_data.append(s.encode('utf-8', 'surrogatepass'))
+        return i
+
+    sections = {}
+    def add_strings(name, strings):
+        sections[name] = array.array('I', (string_id(s) for s in strings))
+    def add_mapping_keys(name, keys):
+        add_strings(name + '_keys', keys)
+        # Slots hold key positions plus one; zero is empty
+        size = 1
+        while size < 2 * len(keys):
+            size *= 2
+        slots = array.array('I', bytes(4 * size))
+        for position, key in enumerate(keys):
+            slot = _string_hash(key) & (size - 1)
+            while slots[slot]:
+                slot = (slot + 1) & (size - 1)
+            slots[slot] = position + 1
+        sections[name + '_hash'] = slots
+    def add_tuples(name, tuples):
+        starts = array.array('I', [0])
+        items = array.array('I')
+        for t in tuples:
+            items.extend(string_id(s) for s in t)
+            starts.append(len(items))
+        sections[name + '_starts'] = starts
+        sections[name + '_items'] = items
+    def add_positions(name, lists):
+        starts = array.array('I', [0])
+        items = array.array('I')
+        for positions in lists:
+            items.extend(positions)
+            starts.append(len(items))
+        sections[name + '_starts'] = starts
+        sections[name + '_items'] = items
+
+    names = sorted(ue.table)
+    chars = [ue.table[name] for name in names]
+    add_mapping_keys('table', names)
+    sections['table_unicode'] = array.array('I', (
+        _NO_STRING if char.unicode_str is None else string_id(char.unicode_str)
+        for char in chars))
+    sections['table_flags'] = array.array('B', (
+        (_FLAG_EMOJIONE if char.is_emojione else 0) | (_FLAG_CUSTOM if char.is_custom else 0)
+        for char in chars))
+    add_tuples('table_aliasing', (char.aliasing for char in chars))
+    # The lowercase form and word boundaries of each name (see _build_word_boundaries),
+    # the boundaries as a little-endian bit mask
+    lowercase_names = [name.lower() for name in names]
+    add_strings('table_lowercase', lowercase_names)
+    boundaries_starts = array.array('I', [0])
+    boundaries_data = bytearray()
+    for name_lowercase in lowercase_names:
+        boundaries = _word_boundaries(name_lowercase)
+        boundaries_data += boundaries.to_bytes((boundaries.bit_length() + 7) // 8, 'little')
+        boundaries_starts.append(len(boundaries_data))
+    sections['table_boundaries_starts'] = boundaries_starts
+    sections['table_boundaries_data'] = array.array('B', boundaries_data)
+
+    for attr in _MAPPED_STR_DICTS:
+        mapping = getattr(ue, attr)
+        keys = sorted(mapping)
+        add_mapping_keys(attr, keys)
+        add_strings(attr + '_values', (mapping[k] for k in keys))
+    for attr in _MAPPED_TUPLE_DICTS:
+        mapping = getattr(ue, attr)
+        keys = sorted(mapping)
+        add_mapping_keys(attr, keys)
+        add_tuples(attr, (mapping[k] for k in keys))
+    for attr in _MAPPED_STR_LISTS:
+        add_strings(attr, getattr(ue, attr))
+    sections['fuzzy_masks'] = array.array('Q', ue.fuzzy_masks)
+    sections['fuzzy_lengths'] = array.array('I', ue.fuzzy_lengths)
+
+    vectors = vector_arrays(ue)
+    for name in _MAPPED_VECTOR_ARRAYS:
+        sections['vector_' + name] = vectors[name]
+    for name in _MAPPED_VECTOR_POSITIONS:
+        mapping = vectors[name]
+        keys = sorted(mapping)
+        add_mapping_keys('vector_' + name, keys)
+        add_positions('vector_' + name, (mapping[k] for k in keys))
+
+    offsets = array.array('I', [0])
+    for data in pool_data:
+        offsets.append(offsets[-1] + len(data))
+    sections['pool_offsets'] = offsets
+    sections['pool_data'] = array.array('B', b''.join(pool_data))
+
+    layout = {}
+    offset = 0
+    for name, data in sections.items():
+        layout[name] = (offset, len(data), data.typecode)
+        offset = _align(offset + len(data) * data.itemsize)
+    header = json.dumps({
+        'version': MAPPED_INDEX_VERSION,
+        'byteorder': sys.byteorder,
+        'key': cache_key,
+        'sections': layout,
+    }).encode('utf-8')
+    data_start = _align(len(MAPPED_INDEX_MAGIC) + 4 + len(header))
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_filename = tempfile.mkstemp(dir=directory, prefix='.index-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAPPED_INDEX_MAGIC)
+            f.write(len(header).to_bytes(4, 'little'))
+            f.write(header)
+            for name, data in sections.items():
+                f.write(b'\0' * (data_start + layout[name][0] - f.tell()))
+                data.tofile(f)
+        os.chmod(temp_filename, 0o644)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        os.unlink(temp_filename)
+        raise
+
+
+class _MappedStrings(object):
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __getitem__(self, i):
+        return str(self.data[self.offsets[i]:self.offsets[i + 1]], 'utf-8', 'surrogatepass')
+
+    def equals(self, i, encoded):
+        '''Compares string i with an encoded string, without decoding it.'''
+        return self.data[self.offsets[i]:self.offsets[i + 1]] == encoded
+
+
+class _MappedStringList(Sequence):
+    def __init__(self, strings, ids):
+        self.strings = strings
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.strings[string_id] for string_id in self.ids[i]]
+        return self.strings[self.ids[i]]
+
+
+class _MappedTuples(object):
+    def __init__(self, strings, starts, items):
+        self.strings = strings
+        self.starts = starts
+        self.items = items
+
+    def __getitem__(self, i):
+        # Strings are only decoded when accessed
+        return _MappedStringList(self.strings, self.items[self.starts[i]:self.starts[i + 1]])
+
+
+class _MappedMapping(Mapping):
+    '''A read-only mapping from strings, looked up in a hash table of its keys.'''
+    def __init__(self, keys, hash_slots, value_at):
+        self.keys_list = keys
+        self.hash_slots = hash_slots
+        self.mask = len(hash_slots) - 1
+        self.value_at = value_at
+
+    def _find(self, key):
+        if not isinstance(key, str):
+            return -1
+        encoded = key.encode('utf-8', 'surrogatepass')
+        strings = self.keys_list.strings
+        ids = self.keys_list.ids
+        slots = self.hash_slots
+        slot = zlib.crc32(encoded) & self.mask
+        while slots[slot]:
+            position = slots[slot] - 1
+            if strings.equals(ids[position], encoded):
+                return position
+            slot = (slot + 1) & self.mask
+        return -1
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        return self.value_at(i)
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __iter__(self):
+        return iter(self.keys_list)
+
+    def __len__(self):
+        return len(self.keys_list)
+
+
+class MappedIndex(object):
+    '''A memory-mapped index written by write_mapped_index.'''
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self.mm)
+        magic_len = len(MAPPED_INDEX_MAGIC)
+        if bytes(buf[:magic_len]) != MAPPED_INDEX_MAGIC:
+            raise ValueError('{} is not a UniEmoji index'.format(filename))
+        header_len = int.from_bytes(buf[magic_len:magic_len + 4], 'little')
+        header = json.loads(bytes(buf[magic_len + 4:magic_len + 4 + header_len]).decode('utf-8'))
+        if header['version'] != MAPPED_INDEX_VERSION or header['byteorder'] != sys.byteorder:
+            raise ValueError('{} has an unsupported format'.format(filename))
+        self.key = header['key']
+
+        data_start = _align(magic_len + 4 + header_len)
+        self.sections = {}
+        for name, (offset, length, typecode) in header['sections'].items():
+            start = data_start + offset
+            end = start + length * array.array(typecode).itemsize
+            if end > len(buf):
+                raise ValueError('{} is truncated'.format(filename))
+            self.sections[name] = buf[start:end].cast(typecode)
+        self.strings = _MappedStrings(self.sections['pool_offsets'], self.sections['pool_data'])
+
+    def _string_list(self, name):
+        return _MappedStringList(self.strings, self.sections[name])
+
+    def _mapping(self, name, value_at):
+        return _MappedMapping(self._string_list(name + '_keys'), self.sections[name + '_hash'], value_at)
+
+    def _tuples(self, name):
+        return _MappedTuples(self.strings, self.sections[name + '_starts'], self.sections[name + '_items'])
+
+    def tables(self):
+        '''Returns the UniEmoji attributes stored in the index, by name.'''
+        strings = self.strings
+        unicode_ids = self.sections['table_unicode']
+        flags = self.sections['table_flags']
+        aliasing = self._tuples('table_aliasing')
+        def char_at(i):
+            char = UniEmojiChar(
+                None if unicode_ids[i] == _NO_STRING else strings[unicode_ids[i]],
+                is_emojione=bool(flags[i] & _FLAG_EMOJIONE),
+                is_custom=bool(flags[i] & _FLAG_CUSTOM))
+            char.aliasing = aliasing[i]
+            return char
+
+        lowercase_names = self._string_list('table_lowercase')
+        boundaries_starts = self.sections['table_boundaries_starts']
+        boundaries_data = self.sections['table_boundaries_data']
+        def word_boundaries_at(i):
+            boundaries = boundaries_data[boundaries_starts[i]:boundaries_starts[i + 1]]
+            return lowercase_names[i], int.from_bytes(boundaries, 'little')
+
+        tables = {
+            'table': self._mapping('table', char_at),
+            'word_boundaries': self._mapping('table', word_boundaries_at),
+        }
+        for attr in _MAPPED_STR_DICTS:
+            tables[attr] = self._mapping(attr, self._string_list(attr + '_values').__getitem__)
+        for attr in _MAPPED_TUPLE_DICTS:
+            tables[attr] = self._mapping(attr, self._tuples(attr).__getitem__)
+        for attr in _MAPPED_STR_LISTS:
+            tables[attr] = self._string_list(attr)
+        tables['fuzzy_masks'] = self.sections['fuzzy_masks']
+        tables['fuzzy_lengths'] = self.sections['fuzzy_lengths']
+
+        vectors = {name: self.sections['vector_' + name] for name in _MAPPED_VECTOR_ARRAYS}
+        for name in _MAPPED_VECTOR_POSITIONS:
+            starts = self.sections['vector_' + name + '_starts']
+            items = self.sections['vector_' + name + '_items']
+            vectors[name] = self._mapping('vector_' + name, lambda i, starts=starts, items=items:
+                                          items[starts[i]:starts[i + 1]])
+        tables['vector_arrays'] = vectors
+        return tables
+
+
+class _NameIndex(object):
+    '''Search indexes over the names in a table.'''
+
+    def _build_index(self):
+        '''Builds the inverted indexes used by _filter.
+
+        Names are split into whitespace-separated words. Since a query word
+        never contains whitespace, it is a substring of a name exactly when it
+        is a substring of one of the name's words, i.e. a prefix of one of the
+        suffixes of a word. Keeping every word suffix sorted lets us find all
+        the matching words with a bisect.
+        '''
+        intern = sys.intern
+        # Most names are lowercase already; exact matches for the others are
+        # looked up here
+        mixed_case_names = defaultdict(list)
+        lowercase_names = {}
+        word_index = defaultdict(list)
+        for name in self.table:
+            name_lowercase = name.lower()
+            if name_lowercase == name:
+                name_lowercase = name
+            else:
+                name_lowercase = intern(name_lowercase)
+                mixed_case_names[name_lowercase].append(name)
+            lowercase_names[name] = name_lowercase
+            for word in set(name_lowercase.split()):
+                word_index[intern(word)].append(name)
+        self.mixed_case_names = {k: tuple(v) for k, v in mixed_case_names.items()}
+        self.word_index = {k: tuple(v) for k, v in word_index.items()}
+
+        suffixes = sorted(
+            (intern(word[i:]), word)
+            for word in self.word_index
+            for i in range(len(word)))
+        self.word_suffixes = [suffix for suffix, _ in suffixes]
+        self.word_suffix_words = [word for _, word in suffixes]
+
+        # Shortest names first, which is also the order of equally-scored matches
+        self.fuzzy_names = sorted(self.table, key=lambda name: (len(name), name))
+        self.fuzzy_lowercase_names = [lowercase_names[name] for name in self.fuzzy_names]
+        self.fuzzy_masks = array.array('Q', (_char_mask(name) for name in self.fuzzy_lowercase_names))
+        self.fuzzy_lengths = array.array('I', (len(name) for name in self.fuzzy_names))
+
+    def _build_word_boundaries(self):
+        '''Maps each name to its lowercase form and word boundaries, to
+        score the names matched by _filter without a vector index.
+        '''
+        word_boundaries = {}
+        for name in self.table:
+            name_lowercase = name.lower()
+            word_boundaries[name] = (name_lowercase, _word_boundaries(name_lowercase))
+        self.word_boundaries = word_boundaries
+
+    def _words_containing(self, substring):
+        suffixes = self.word_suffixes
+        start = bisect.bisect_left(suffixes, substring)
+        words = set()
+        for i in range(start, len(suffixes)):
+            if not suffixes[i].startswith(substring):
+                break
+            words.add(self.word_suffix_words[i])
+        return words
+
+    def _fuzzy_prefilter(self, query, pool, exclude, interrupted=None):
+        '''Cheaply discards the names that can't get a positive fuzzy score.
+
+        Returns (name, lowercase name) pairs, shortest names first.
+        A positive score requires every query character to be in an 'equal'
+        block, in order, so the name must be at least as long as the query,
+        contain all of its characters (checked first using the character
+        masks), and contain it as a subsequence.
+
+        The second return value is False if the search was interrupted, and
+        the list is incomplete.
+        '''
+        query_len = len(query)
+        query_mask = _char_mask(query)
+        names = self.fuzzy_names
+        lowercase_names = self.fuzzy_lowercase_names
+        masks = self.fuzzy_masks
+        fuzzy_names = []
+        # The names are sorted by length, skip the ones shorter than the query
+        for index in range(bisect.bisect_left(self.fuzzy_lengths, query_len), len(masks)):
+            if interrupted is not None and not index & 511 and interrupted():
+                return fuzzy_names, False
+            if query_mask & ~masks[index]: continue
+            candidate = names[index]
+            if candidate in exclude: continue
+            if pool is not None and candidate not in pool: continue
+            candidate_lowercase = lowercase_names[index]
+            if not _is_subsequence(query, candidate_lowercase): continue
+            fuzzy_names.append((candidate, candidate_lowercase))
+        return fuzzy_names, True
+
+
+def vector_arrays(index):
+    '''Returns the arrays a VectorIndex of index's names is made of.
+
+    They don't need NumPy, so that they can be stored in a mapped index
+    (see VectorIndex), and are returned as a dict of array.array by name,
+    plus the unicode_positions and alias_positions mappings.
+    '''
+    names = index.fuzzy_names
+    lowercase_names = index.fuzzy_lowercase_names
+    buffer = '\0'.join(lowercase_names) + '\0'
+    codes = array.array('I')
+    codes.frombytes(buffer.encode('utf-32-le' if sys.byteorder == 'little' else 'utf-32-be', 'surrogatepass'))
+    offsets = array.array('q', [0])
+    for name in lowercase_names:
+        offsets.append(offsets[-1] + len(name) + 1)
+    # The separators aren't word characters, so no word spans two names
+    boundaries = bytearray(len(buffer) + 1)
+    for m in _WORD_RE.finditer(buffer):
+        boundaries[m.start()] = boundaries[m.end()] = 1
+
+    has_unicode = bytearray(len(names))
+    has_alias = bytearray(len(names))
+    unicode_positions = defaultdict(list)
+    alias_positions = defaultdict(list)
+    for position, name in enumerate(names):
+        char = index.table[name]
+        if char.unicode_str:
+            has_unicode[position] = 1
+            unicode_positions[char.unicode_str].append(position)
+        if char.aliasing:
+            has_alias[position] = 1
+            for unicode_str in char.aliasing:
+                alias_positions[unicode_str].append(position)
+    return {
+        'codes': codes,
+        'offsets': offsets,
+        'boundaries': array.array('B', boundaries),
+        'has_unicode': array.array('B', has_unicode),
+        'has_alias': array.array('B', has_alias),
+        'unicode_positions': dict(unicode_positions),
+        'alias_positions': dict(alias_positions),
+    }
+
+
+class VectorIndex(object):
+    '''The names of a _NameIndex packed into NumPy arrays, to match a query
+    against all of them at once.
+
+    The lowercase names are concatenated, separated by NUL characters, into
+    one array of code points, with an array of the offset of each name. The
+    names are in fuzzy search order, shortest first, which is also the
+    order of equally scored matches. Names are referred to by their position
+    in that order.
+
+    The arrays are the ones returned by vector_arrays(), which a mapped
+    index stores, so that they're used from the mapped file as they are.
+    '''
+    def __init__(self, index, arrays=None):
+        if arrays is None:
+            arrays = vector_arrays(index)
+        self.names = index.fuzzy_names
+        self.lowercase_names = index.fuzzy_lowercase_names
+        self.lengths = numpy.array(index.fuzzy_lengths, dtype=numpy.int64)
+        self.masks = numpy.frombuffer(index.fuzzy_masks, dtype=numpy.uint64)
+        self.codes = numpy.frombuffer(arrays['codes'], dtype=numpy.uint32)
+        self.offsets = numpy.frombuffer(arrays['offsets'], dtype=numpy.int64)
+        # boundaries[i] is whether there's a word boundary (\b) before codes[i]
+        self.boundaries = numpy.frombuffer(arrays['boundaries'], dtype=bool)
+
+        # What each name stands for, and the names standing for each sequence
+        self.has_unicode = numpy.frombuffer(arrays['has_unicode'], dtype=bool)
+        self.has_alias = numpy.frombuffer(arrays['has_alias'], dtype=bool)
+        self.unicode_positions = arrays['unicode_positions']
+        self.alias_positions = arrays['alias_positions']
+
+    def position(self, name):
+        '''Returns the position of name, or None.'''
+        names = self.names
+        key = (len(name), name)
+        low, high = 0, len(names)
+        while low < high:
+            middle = (low + high) // 2
+            if (int(self.lengths[middle]), names[middle]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(names) and names[low] == name:
+            return low
+        return None
+
+    def _occurrences(self, word):
+        '''Returns the sorted buffer offsets at which word occurs.'''
+        codes = self.codes
+        word_codes = numpy.frombuffer(word.encode('utf-32-le', 'surrogatepass'), dtype='<u4')
+        end = len(codes) - len(word_codes) + 1
+        if not len(word_codes) or end <= 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        found = numpy.flatnonzero(codes[:end] == word_codes[0])
+        for i in range(1, len(word_codes)):
+            found = found[codes[found + i] == word_codes[i]]
+        return found
+
+    def substring_scores(self, words):
+        '''Scores every name as a substring match of words, like _filter.
+
+        Returns whether each name contains any of the words, and its score.
+        '''
+        count = len(self.names)
+        any_found = numpy.zeros(count, dtype=bool)
+        if not words:
+            return any_found, numpy.zeros(count)
+        position_sum = numpy.zeros(count, dtype=numpy.int64)
+        bonus = numpy.zeros(count, dtype=numpy.int64)
+        for word in words:
+            found = self._occurrences(word)
+            # The first occurrence in each name gives its position
+            positions = numpy.searchsorted(self.offsets, found, side='right') - 1
+            first = numpy.ones(len(found), dtype=bool)
+            first[1:] = positions[1:] != positions[:-1]
+            word_position = numpy.full(count, 100, dtype=numpy.int64)
+            word_position[positions[first]] = found[first] - self.offsets[positions[first]]
+            position_sum += word_position
+            any_found[positions] = True
+
+            # Any occurrence can be a word or prefix match
+            starts_word = self.boundaries[found]
+            ends_word = self.boundaries[found + len(word)]
+            exact_word_match = numpy.zeros(count, dtype=bool)
+            exact_word_match[positions[starts_word & ends_word]] = True
+            prefix_match = numpy.zeros(count, dtype=bool)
+            prefix_match[positions[starts_word]] = True
+            bonus += 20 * exact_word_match + 10 * (prefix_match & ~exact_word_match)
+
+        scores = -(position_sum / float(len(words)))
+        scores += bonus
+        return any_found, scores
+
+    def _usage_bonuses(self, usage):
+        unicode_bonus = numpy.zeros(len(self.names))
+        alias_bonus = numpy.zeros(len(self.names))
+        for sequence in list(usage.entries):
+            bonus = usage.bonus(sequence)
+            for position in self.unicode_positions.get(sequence, ()):
+                unicode_bonus[position] = bonus
+            for position in self.alias_positions.get(sequence, ()):
+                alias_bonus[position] = max(alias_bonus[position], bonus)
+        return unicode_bonus, alias_bonus
+
+    def ranked_matches(self, candidates, scores, usage=None):
+        '''Yields the substring matches among the candidates (a mask of
+        positions) as _filter's match tuples, in _match_sort_key order.
+        '''
+        positions = numpy.flatnonzero(candidates)
+        unicode_positions = positions[self.has_unicode[positions]]
+        alias_positions = positions[self.has_alias[positions]]
+        unicode_scores = scores[unicode_positions]
+        alias_scores = scores[alias_positions]
+        if usage is not None:
+            unicode_bonus, alias_bonus = self._usage_bonuses(usage)
+            unicode_scores = unicode_scores + unicode_bonus[unicode_positions]
+            alias_scores = alias_scores + alias_bonus[alias_positions]
+
+        match_types = numpy.concatenate((numpy.full(len(unicode_positions), 10), numpy.full(len(alias_positions), 5)))
+        candidate_types = numpy.concatenate((numpy.full(len(unicode_positions), CANDIDATE_UNICODE),
+                                             numpy.full(len(alias_positions), CANDIDATE_ALIAS)))
+        positions = numpy.concatenate((unicode_positions, alias_positions))
+        scores = numpy.concatenate((unicode_scores, alias_scores))
+        # The same order as _match_sort_key
+        order = numpy.lexsort((candidate_types, positions, -scores, -match_types))
+        names = self.names
+        for i in order.tolist():
+            yield (int(match_types[i]), float(scores[i]), names[int(positions[i])], int(candidate_types[i]))
+
+    def fuzzy_prefilter(self, query, exclude, interrupted=None, found=None):
+        '''Like _NameIndex._fuzzy_prefilter, checking the lengths and the
+        character masks of all names at once; exclude is a mask of positions.
+
+        The positions of the names returned are also set in found, a mask of
+        positions, if it's given.
+        '''
+        query_mask = numpy.uint64(_char_mask(query))
+        candidates = (self.lengths >= len(query)) & ((self.masks & query_mask) == query_mask) & ~exclude
+        names = self.names
+        lowercase_names = self.lowercase_names
+        fuzzy_names = []
+        for i, position in enumerate(numpy.flatnonzero(candidates).tolist()):
+            if interrupted is not None and not i & 511 and interrupted():
+                return fuzzy_names, False
+            candidate_lowercase = lowercase_names[position]
+            if _is_subsequence(query, candidate_lowercase):
+                fuzzy_names.append((names[position], candidate_lowercase))
+                if found is not None:
+                    found[position] = True
+        return fuzzy_names, True
+
+
+class CustomEntries(_NameIndex):
+    '''The entries of the custom files, searched along with the built-in tables.
+
+    They are kept apart from the built-in tables, so that the custom files
+    can be reloaded without reloading those. An entry replaces the built-in
+    one of the same name.
+    '''
+    def __init__(self, custom_files):
+        '''custom_files maps each file to its entries, later files taking precedence.'''
+        _import_optional_modules()
+        self.table = {}
+        for entries in custom_files.values():
+            for name, unicode_str in entries.items():
+                self.table[name] = UniEmojiChar(unicode_str, is_custom=True)
+        self._build_index()
+        self._build_word_boundaries()
+
+    def __len__(self):
+        return len(self.table)
+
+
+# Parsing the source files
+#
+# Each file is parsed on its own into a list of entries, which UniEmoji then
+# merges into its tables.
+
+def _parse_sequences(filename, skip_ranges):
+    entries = []
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            line = line.strip()
+            if not line:
+                continue
+
+            fields = line.split(';')
+            if skip_ranges and '..' in fields[0]:
+                continue
+            unicode_str = ''.join(chr(int(codepoint, 16)) for codepoint in fields[0].strip().split(' '))
+            description = fields[2][:fields[2].find('#')].strip()
+            entries.append((unicode_str, description))
+    return entries
+
+def _parse_emoji_sequences(filename):
+    '''Returns (unicode_str, description) for every sequence.'''
+    entries = _parse_sequences(filename, skip_ranges=True)
+    return [(unicode_str, 'flag of ' + description[6:] if description.startswith('flag: ') else description)
+            for unicode_str, description in entries]
+
+def _parse_unicode_data(filename):
+    '''Returns (unicode_char, lowercase name) for every character in a valid category and range.'''
+    entries = []
+    with open(filename, encoding='utf-8') as unicodedata:
+        for line in unicodedata:
+            if not line.strip(): continue
+            code, name, category, _ = line.split(';', 3)
+            code = int(code, 16)
+            if not is_valid_symbol(code, category):
+                continue
+            entries.append((chr(code), name.lower()))
+    return entries
+
+def _iter_json_object(text):
+    '''Yields the (key, value) pairs of the JSON object in text.
+
+    The values are decoded one at a time, so unlike json.loads, the whole
+    object is never in memory at once.
+    '''
+    scan = json.JSONDecoder().scan_once
+    whitespace = json.decoder.WHITESPACE.match
+
+    def skip(i):
+        # Most JSON files are compact, so avoid the regex when possible
+        if text[i:i + 1] in ('', ' ', '\t', '\n', '\r'):
+            return whitespace(text, i).end()
+        return i
+
+    def expect(i, char):
+        i = skip(i)
+        if text[i:i + 1] != char:
+            raise json.JSONDecodeError('Expecting {!r}'.format(char), text, i)
+        return skip(i + 1)
+
+    def decode(i):
+        try:
+            return scan(text, i)
+        except StopIteration as e:
+            raise json.JSONDecodeError('Expecting value', text, e.value) from None
+
+    i = expect(0, '{')
+    if text[i:i + 1] != '}':
+        while True:
+            if text[i:i + 1] != '"':
+                raise json.JSONDecodeError('Expecting property name enclosed in double quotes', text, i)
+            key, i = decode(i)
+            value, i = decode(expect(i, ':'))
+            yield key, value
+            i = skip(i)
+            if text[i:i + 1] == '}':
+                break
+            i = expect(i, ',')
+    if skip(i + 1) != len(text):
+        raise json.JSONDecodeError('Extra data', text, i + 1)
+
+def _parse_joypixels(filename):
+    '''Returns (unicode_str, shortname, is_flag, name, keywords, ascii aliases) for every emoji.
+
+    Only the fields used are kept from each entry, as it's decoded.
+    '''
+    entries = []
+    with open(filename, encoding='utf-8') as f:
+        text = f.read()
+    for _, emoji_info in _iter_json_object(text):
+        codepoints = emoji_info['code_points']['fully_qualified']
+        unicode_str = ''.join(chr(int(codepoint, 16)) for codepoint in codepoints.split('-'))
+        entries.append((unicode_str, emoji_info['shortname'][1:-1], emoji_info['category'] == 'flags',
+                        emoji_info['name'], emoji_info.get('keywords', []), emoji_info.get('ascii', [])))
+    return entries
+
+def _parse_zwj_sequences(filename):
+    '''Returns (unicode_str, description) for every sequence.'''
+    return _parse_sequences(filename, skip_ranges=False)
+
+# The parser and source file of each loading stage
+_SOURCE_PARSERS = {
+    'emoji_sequences': (_parse_emoji_sequences, SOURCE_FILES[0]),
+    'unicode_data': (_parse_unicode_data, SOURCE_FILES[1]),
+    'joypixels': (_parse_joypixels, SOURCE_FILES[2]),
+    'zwj_sequences': (_parse_zwj_sequences, SOURCE_FILES[3]),
+}
+
+def _parse_source(stage):
+    '''Returns the time taken, and the entries parsed for a loading stage.'''
+    start = time.perf_counter()
+    parse, filename = _SOURCE_PARSERS[stage]
+    entries = parse(filename)
+    return time.perf_counter() - start, entries
+
+class UniEmoji(_NameIndex):
+    # Loading stages, in order. The source file of each one is parsed on its
+    # own (see _SOURCE_PARSERS), and its entries are then merged into the
+    # tables by the _merge_<stage> method, relying on the names merged before
+    # it. The core stages are enough to answer queries.
+    CORE_STAGES = ('emoji_sequences', 'unicode_data')
+    LOAD_STAGES = CORE_STAGES + ('joypixels', 'zwj_sequences')
+
+    # Attributes that are kept when the fully loaded tables replace the core ones
+    _STATE_ATTRS = frozenset(('loaded', 'generation', 'update_callbacks', '_lock', 'fuzzy_candidate_limit',
+                              'usage', 'result_cache', 'custom', 'custom_files', 'stats'))
+
+    def __init__(self, use_cache=True, lazy=False, shared=False, core=None):
+        '''Loads the tables, from the index cache if it's up to date.
+
+        With lazy=True and no usable cache, only the core Unicode data is
+        loaded before returning, and the rest is loaded by a background
+        thread. Once it's done, the tables are replaced, generation is
+        incremented, and every function in update_callbacks is called
+        (from the background thread). That thread starts from copies of the
+        core tables, passed as core, the UniEmoji they come from.
+
+        With shared=True, the tables are queried directly from a
+        memory-mapped index (see MappedIndex), shared by every process
+        using it. The index in $UNIEMOJI_SHARED_INDEX is used if it's up to
+        date, else the one in the cache directory, which is written when
+        missing or stale.
+
+        The custom entries are always loaded from the custom files, and are
+        not part of the cached tables (see CustomEntries).
+        '''
         super(UniEmoji, self).__init__()
+        self.loaded = threading.Event()
+        self.generation = 0
+        self.update_callbacks = []
+        self._lock = threading.RLock()
         self.table = defaultdict(UniEmojiChar)
         self.unicode_chars_to_names = {}
         self.unicode_chars_to_shortnames = {}
@@ -153,61 +1337,258 @@ class UniEmoji():
         self.reverse_ascii_table = {}
         self.alias_table = {}
         self.has_text_representation = {}
+        # The entries of each custom file, and the CustomEntries built from them
+        self.custom_files = {}
+        self.custom = None
+        self.fuzzy_candidate_limit = FUZZY_CANDIDATE_LIMIT
+        # A UsageStore, to rank the characters picked often or recently higher
+        self.usage = None
+        self.result_cache = ResultCache()
+        # A Stats recording the time taken by each step of the searches
+        self.stats = None
+        # A VectorIndex of the built-in names, if NumPy is available, else
+        # their lowercase forms and word boundaries (see _build_word_boundaries)
+        self.vector_index = None
+        self.word_boundaries = {}
+        # The arrays of the VectorIndex, when they come from a mapped index
+        self.vector_arrays = None
+        # Time spent in each loading step, in seconds
+        self.load_times = {}
 
-        # Load emoji sequences
-        with open(os.path.join(__base_dir__, 'unicode', 'emoji-sequences.txt'), encoding='utf-8') as f:
-            for line in f:
-                if line.startswith('#'):
-                    continue
-                line = line.strip()
-                if not line:
-                    continue
+        _import_optional_modules()
+        complete = True
+        cache_key = self._cache_key() if use_cache else None
+        shared = shared and cache_key is not None
+        if not shared or not self._timed('load_mapped_index', self._load_mapped_index, cache_key):
+            if cache_key is None or not self._timed('load_cache', self._load_cache, cache_key):
+                if lazy:
+                    self._timed('load_sources', self._load_sources, self.CORE_STAGES)
+                    complete = False
+                elif core is not None:
+                    self._timed('copy_core', self._copy_core_tables, core)
+                    self._timed('load_sources', self._load_sources, self.LOAD_STAGES[len(self.CORE_STAGES):])
+                    if cache_key is not None:
+                        self._timed('save_cache', self._save_cache, cache_key)
+                else:
+                    self._timed('load_sources', self._load_sources)
+                    if cache_key is not None:
+                        self._timed('save_cache', self._save_cache, cache_key)
 
-                fields = line.split(';')
-                if '..' in fields[0]:
-                    continue
-                unicode_str = ''.join(chr(int(codepoint, 16)) for codepoint in fields[0].strip().split(' '))
-                description = fields[2][:fields[2].find('#')].strip()
-                if description.startswith('flag: '):
-                    description = 'flag of ' + description[6:]
-                self.unicode_chars_to_names[unicode_str] = description
-                self.table[description] = UniEmojiChar(unicode_str)
+            self._timed('compact', self._compact)
+            self._timed('build_index', self._build_index)
 
-        # Load unicode characters
-        with open(os.path.join(__base_dir__, 'unicode', 'UnicodeData.txt'), encoding='utf-8') as unicodedata:
-            for line in unicodedata.readlines():
-                if not line.strip(): continue
-                code, name, category, _ = line.split(';', 3)
-                code = int(code, 16)
-                if category not in VALID_CATEGORIES:
-                    continue
-                if not in_range(code):
-                    continue
-                name = name.lower()
-                unicode_char = chr(code)
-                if unicode_char not in self.unicode_chars_to_names:
-                    char_with_fe0f = unicode_char + '\ufe0f'
-                    if char_with_fe0f in self.unicode_chars_to_names:
-                        self.has_text_representation[char_with_fe0f] = unicode_char
-                        if name != self.unicode_chars_to_names[char_with_fe0f]:
-                            if name not in self.table:
-                                self.table[name] = UniEmojiChar(char_with_fe0f)
-                    else:
-                        self.table[name] = UniEmojiChar(unicode_char)
-                        self.unicode_chars_to_names[unicode_char] = name
-
-        # Load emojione file
-        alias_counter = Counter()
-        temp_alias_table = defaultdict(set)
+            if shared and complete:
+                self._timed('save_mapped_index', self._save_mapped_index, cache_key)
+
+        if numpy is not None:
+            self._timed('build_vector_index', self._build_vector_index)
+        elif not self.word_boundaries:
+            # A mapped index has them already
+            self._timed('build_word_boundaries', self._build_word_boundaries)
+        self._timed('load_custom', self._load_custom)
+
+        if complete:
+            self.loaded.set()
+        else:
+            threading.Thread(target=self._finish_loading, args=(use_cache, shared), daemon=True).start()
+
+    def _finish_loading(self, use_cache, shared):
+        try:
+            full = type(self)(use_cache=use_cache, shared=shared, core=self)
+        except Exception:
+            debug('Failed to load emoji data: {}'.format(sys.exc_info()[1]))
+        else:
+            with self._lock:
+                for attr, value in vars(full).items():
+                    if attr not in self._STATE_ATTRS:
+                        setattr(self, attr, value)
+                self.generation += 1
+            for callback in list(self.update_callbacks):
+                callback()
+        finally:
+            self.loaded.set()
+
+    def _copy_core_tables(self, core):
+        '''Copies the tables of core, loaded with only the CORE_STAGES, so
+        that the other stages can be merged into them while core is in use.
+        Alias lists are turned back into lists (see _compact).
+        '''
+        for name, char in core.table.items():
+            copy = self.table[name]
+            copy.unicode_str = char.unicode_str
+            copy.aliasing = list(char.aliasing)
+            copy.is_emojione = char.is_emojione
+            copy.is_custom = char.is_custom
+        for attr in ('unicode_chars_to_names', 'unicode_chars_to_shortnames', 'ascii_table',
+                     'reverse_ascii_table', 'alias_table', 'has_text_representation'):
+            setattr(self, attr, dict(getattr(core, attr)))
 
-        emojione_data = json.load(open(os.path.join(__base_dir__, 'joypixels_emoji.json'), encoding='utf-8'))
-        for emoji_info in emojione_data.values():
+    def _build_vector_index(self):
+        self.vector_index = VectorIndex(self, self.vector_arrays)
 
-            codepoints = emoji_info['code_points']['fully_qualified']
+    def wait_until_loaded(self, timeout=None):
+        '''Waits for a lazy load to finish. Returns False on timeout.'''
+        return self.loaded.wait(timeout)
 
-            unicode_str = ''.join(chr(int(codepoint, 16)) for codepoint in codepoints.split('-'))
-            emoji_shortname = emoji_info['shortname'][1:-1]
+    def _cache_key(self):
+        '''Describes the state of every input the tables are built from.
 
+        Source data files are identified by their mtime and size.
+        '''
+        key = [CACHE_VERSION]
+        try:
+            for filename in SOURCE_FILES:
+                st = os.stat(filename)
+                key.append((filename, st.st_mtime_ns, st.st_size))
+        except OSError:
+            return None
+        return tuple(key)
+
+    @staticmethod
+    def _data_key():
+        '''Like _cache_key, for the indexes built ahead of time.
+
+        Source data files are identified by their path relative to this
+        module, their size and a checksum of their contents, since their
+        mtime changes when they're installed.
+        '''
+        key = [CACHE_VERSION]
+        try:
+            for filename in SOURCE_FILES:
+                key.append((os.path.relpath(filename, __base_dir__ or os.curdir), os.stat(filename).st_size,
+                            _file_checksum(filename)))
+        except OSError:
+            return None
+        return tuple(key)
+
+    def _mapped_index_paths(self, cache_key):
+        '''Returns (filename, key) for every index that can be mapped, in order of preference.'''
+        data_key = self._data_key()
+        paths = []
+        if os.environ.get('UNIEMOJI_SHARED_INDEX'):
+            paths.append((os.environ['UNIEMOJI_SHARED_INDEX'], data_key))
+        paths.append((BUNDLED_INDEX, data_key))
+        paths.append((os.path.join(CACHE_DIR, MAPPED_INDEX_FILENAME), cache_key))
+        return paths
+
+    def _load_mapped_index(self, cache_key):
+        for filename, key in self._mapped_index_paths(cache_key):
+            try:
+                index = MappedIndex(filename)
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError, KeyError):
+                debug('Failed to load index {}: {}'.format(filename, sys.exc_info()[1]))
+                continue
+            if index.key != _json_key(key):
+                debug('Index {} is stale'.format(filename))
+                continue
+            for attr, value in index.tables().items():
+                setattr(self, attr, value)
+            debug('Mapped index {}'.format(filename))
+            return True
+        return False
+
+    def _save_mapped_index(self, cache_key):
+        filename = os.path.join(CACHE_DIR, MAPPED_INDEX_FILENAME)
+        try:
+            write_mapped_index(self, filename, cache_key)
+        except OSError:
+            debug('Failed to save index {}: {}'.format(filename, sys.exc_info()[1]))
+            return
+        # Query the new index rather than the tables in this process' memory
+        self._load_mapped_index(cache_key)
+
+    def _load_cache(self, cache_key):
+        cache_filename = os.path.join(CACHE_DIR, CACHE_FILENAME)
+        try:
+            with open(cache_filename, 'rb') as f:
+                data = pickle.load(f)
+            if data['key'] != cache_key:
+                debug('Index cache {} is stale'.format(cache_filename))
+                return False
+            for name, (unicode_str, aliasing, is_emojione, is_custom) in data['table'].items():
+                char = UniEmojiChar(unicode_str, is_emojione=is_emojione, is_custom=is_custom)
+                char.aliasing = aliasing
+                self.table[name] = char
+            self.unicode_chars_to_names = data['unicode_chars_to_names']
+            self.unicode_chars_to_shortnames = data['unicode_chars_to_shortnames']
+            self.ascii_table = data['ascii_table']
+            self.reverse_ascii_table = data['reverse_ascii_table']
+            self.has_text_representation = data['has_text_representation']
+        except FileNotFoundError:
+            return False
+        except Exception:
+            debug('Failed to load index cache {}: {}'.format(cache_filename, sys.exc_info()[1]))
+            self.table.clear()
+            return False
+        debug('Loaded index cache from {}'.format(cache_filename))
+        return True
+
+    def _save_cache(self, cache_key):
+        data = {
+            'key': cache_key,
+            'table': {
+                name: (char.unicode_str, char.aliasing, char.is_emojione, char.is_custom)
+                for name, char in self.table.items()
+            },
+            'unicode_chars_to_names': self.unicode_chars_to_names,
+            'unicode_chars_to_shortnames': self.unicode_chars_to_shortnames,
+            'ascii_table': self.ascii_table,
+            'reverse_ascii_table': self.reverse_ascii_table,
+            'has_text_representation': self.has_text_representation,
+        }
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            # Write to a temporary file first, so concurrent engines never see a partial cache
+            fd, temp_filename = tempfile.mkstemp(dir=CACHE_DIR, prefix='.index-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(temp_filename, os.path.join(CACHE_DIR, CACHE_FILENAME))
+            except BaseException:
+                os.unlink(temp_filename)
+                raise
+        except OSError:
+            debug('Failed to save index cache: {}'.format(sys.exc_info()[1]))
+
+    def _timed(self, step, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.load_times[step] = time.perf_counter() - start
+
+    def _load_sources(self, stages=None):
+        '''Parses the source file of each stage, and merges it, in order.'''
+        for stage in stages or self.LOAD_STAGES:
+            seconds, entries = _parse_source(stage)
+            self.load_times['parse_' + stage] = seconds
+            self._timed('merge_' + stage, getattr(self, '_merge_' + stage), entries)
+
+    def _merge_emoji_sequences(self, entries):
+        for unicode_str, description in entries:
+            self.unicode_chars_to_names[unicode_str] = description
+            self.table[description] = UniEmojiChar(unicode_str)
+
+    def _merge_unicode_data(self, entries):
+        for unicode_char, name in entries:
+            if unicode_char not in self.unicode_chars_to_names:
+                char_with_fe0f = unicode_char + '\ufe0f'
+                if char_with_fe0f in self.unicode_chars_to_names:
+                    self.has_text_representation[char_with_fe0f] = unicode_char
+                    if name != self.unicode_chars_to_names[char_with_fe0f]:
+                        if name not in self.table:
+                            self.table[name] = UniEmojiChar(char_with_fe0f)
+                else:
+                    self.table[name] = UniEmojiChar(unicode_char)
+                    self.unicode_chars_to_names[unicode_char] = name
+
+    def _merge_joypixels(self, entries):
+        alias_counter = Counter()
+        temp_alias_table = defaultdict(set)
+
+        for unicode_str, emoji_shortname, is_flag, long_name, keywords, ascii_aliases in entries:
             if unicode_str + '\ufe0f' in self.unicode_chars_to_names:
                 unicode_str = unicode_str + '\ufe0f'
             self.unicode_chars_to_shortnames[unicode_str] = emoji_shortname
@@ -219,7 +1600,7 @@ class UniEmoji():
                 # Clashes turn into aliases.
                 if unicode_str != self.table[emoji_shortname].unicode_str:
                     self.table[emoji_shortname].aliasing.append(unicode_str)
-            elif emoji_info['category'] == 'flags':
+            elif is_flag:
                 pass # No special handling of flags
             else:
                 self.table[emoji_shortname] = UniEmojiChar(unicode_str, is_emojione=True)
@@ -228,18 +1609,17 @@ class UniEmoji():
             # (because it's a combination of characters), use emojione's
             # descriptive name, and set the shortname as an alias
             if unicode_str not in self.unicode_chars_to_names:
-                long_name = emoji_info['name']
                 self.unicode_chars_to_names[unicode_str] = long_name
                 if long_name not in self.table:
                     self.table[long_name] = UniEmojiChar(unicode_str)
 
-            for alias in emoji_info.get('keywords', []):
+            for alias in keywords:
                 alias_counter[alias] += 1
                 temp_alias_table[alias].add(unicode_str)
 
-            for ascii_aliases in emoji_info.get('ascii', []):
-                self.ascii_table[ascii_aliases] = unicode_str
-                self.reverse_ascii_table[unicode_str] = emoji_info['name']
+            for ascii_alias in ascii_aliases:
+                self.ascii_table[ascii_alias] = unicode_str
+                self.reverse_ascii_table[unicode_str] = long_name
 
         # Load less-frequent aliases from emojione file
         for alias, n in alias_counter.most_common():
@@ -247,61 +1627,213 @@ class UniEmoji():
                 continue
             self.table[alias].aliasing.extend(temp_alias_table[alias])
 
-        # Load emoji ZWJ sequences
-        with open(os.path.join(__base_dir__, 'unicode', 'emoji-zwj-sequences.txt'), encoding='utf-8') as f:
-            for line in f:
-                if line.startswith('#'):
-                    continue
-                line = line.strip()
-                if not line:
-                    continue
+    def _merge_zwj_sequences(self, entries):
+        for unicode_str, description in entries:
+            if unicode_str not in self.unicode_chars_to_names:
+                self.unicode_chars_to_names[unicode_str] = description
+                self.table[description] = UniEmojiChar(unicode_str)
+
+    def _load_custom(self):
+        self.custom_files = self._read_custom_files()
+        self.custom = CustomEntries(self.custom_files) if any(self.custom_files.values()) else None
 
-                fields = line.split(';')
-                unicode_str = ''.join(chr(int(codepoint, 16)) for codepoint in fields[0].strip().split(' '))
-                description = fields[2][:fields[2].find('#')].strip()
-                if unicode_str not in self.unicode_chars_to_names:
-                    self.unicode_chars_to_names[unicode_str] = description
-                    self.table[description] = UniEmojiChar(unicode_str)
+    def _read_custom_files(self):
+        '''Returns the entries of every custom file, the preferred one last.
 
-        # Load custom file(s)
+        A file that fails to load keeps its previous entries, if any.
+        '''
+        custom_files = {}
         for d in reversed(SETTINGS_DIRS):
             custom_filename = os.path.join(d, 'custom.json')
             debug('Loading custom emoji from {}'.format(custom_filename))
             if os.path.isfile(custom_filename):
-                custom_table = None
                 try:
                     with open(custom_filename, encoding='utf-8') as f:
                         custom_table = json.loads(f.read())
-                except:
-                    error = sys.exc_info()[1]
-                    debug(error)
-                    self.table = {
-                        'Failed to load custom file {}: {}'.format(custom_filename, error): 'ERROR'
-                    }
-                    break
+                    if not isinstance(custom_table, dict) or not all(isinstance(v, str) for v in custom_table.values()):
+                        raise ValueError('Expected an object mapping names to characters')
+                except (OSError, ValueError):
+                    debug('Failed to load custom file {}: {}'.format(custom_filename, sys.exc_info()[1]))
+                    custom_table = self.custom_files.get(custom_filename, {})
                 else:
                     debug(custom_table)
-                    for k, v in custom_table.items():
-                        self.table[k] = UniEmojiChar(v, is_custom=True)
+                custom_files[custom_filename] = custom_table
+        return custom_files
+
+    def reload_custom(self):
+        '''Reloads the custom files. Returns whether any custom entry changed.
+
+        Only the custom entries are replaced; when they do, generation is
+        incremented, and every function in update_callbacks is called.
+        '''
+        custom_files = self._read_custom_files()
+        if custom_files == self.custom_files:
+            return False
+        custom = CustomEntries(custom_files) if any(custom_files.values()) else None
+        with self._lock:
+            old_table = self.custom.table if self.custom is not None else {}
+            new_table = custom.table if custom is not None else {}
+            self.custom_files = custom_files
+            self.custom = custom
+            self.generation += 1
+        debug('Custom entries reloaded: {} added, {} removed, {} changed'.format(
+            len(new_table.keys() - old_table.keys()),
+            len(old_table.keys() - new_table.keys()),
+            sum(1 for name in new_table.keys() & old_table.keys()
+                if new_table[name].unicode_str != old_table[name].unicode_str)))
+        for callback in list(self.update_callbacks):
+            callback()
+        return True
+
+    @staticmethod
+    def _custom_files_state():
+        state = []
+        for d in SETTINGS_DIRS:
+            try:
+                st = os.stat(os.path.join(d, 'custom.json'))
+            except OSError:
+                state.append(None)
+            else:
+                state.append((st.st_mtime_ns, st.st_size))
+        return state
+
+    def watch_custom_files(self, interval=CUSTOM_POLL_INTERVAL):
+        '''Reloads the custom entries whenever a custom file changes.
+
+        Changes are noticed with inotify if inotify_simple is installed,
+        and otherwise by checking the files every interval seconds, from a
+        background thread.
+        '''
+        threading.Thread(target=self._watch_custom_files, args=(interval,), daemon=True).start()
+
+    def _watch_custom_files(self, interval):
+        inotify = None
+        if inotify_simple is not None:
+            flags = inotify_simple.flags
+            try:
+                inotify = inotify_simple.INotify()
+                for d in SETTINGS_DIRS:
+                    inotify.add_watch(d, flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM |
+                                         flags.CREATE | flags.DELETE)
+            except OSError:
+                debug('Failed to watch the custom files: {}'.format(sys.exc_info()[1]))
+                inotify = None
+
+        state = self._custom_files_state()
+        while True:
+            if inotify is not None:
+                # Wait a little for the rest of the events of a save
+                events = inotify.read(read_delay=100)
+                if not any(event.name == 'custom.json' for event in events):
+                    continue
+            else:
+                time.sleep(interval)
+            new_state = self._custom_files_state()
+            if new_state == state:
+                continue
+            state = new_state
+            try:
+                self.reload_custom()
+            except Exception:
+                debug('Failed to reload the custom files: {}'.format(sys.exc_info()[1]))
+
+    def _compact(self):
+        '''Shrinks the loaded tables.
+
+        The same names and character sequences appear in several tables, and
+        often come from different source files, so they are interned to be
+        stored only once. Alias lists become tuples, all empty ones sharing
+        the same object.
+        '''
+        intern = sys.intern
+        table = defaultdict(UniEmojiChar)
+        for name, char in self.table.items():
+            if char.unicode_str is not None:
+                char.unicode_str = intern(char.unicode_str)
+            char.aliasing = tuple(intern(unicode_str) for unicode_str in char.aliasing)
+            table[intern(name)] = char
+        self.table = table
+
+        for attr in ('unicode_chars_to_names', 'unicode_chars_to_shortnames', 'ascii_table',
+                     'reverse_ascii_table', 'has_text_representation'):
+            setattr(self, attr, {intern(k): intern(v) for k, v in getattr(self, attr).items()})
+
+    def memory_usage(self):
+        '''Returns the approximate number of bytes used by each table.
 
-    def _filter(self, query, limit=100):
-        if len(self.table) <= 10:
-            # this only happens if something went wrong; it's our cheap way of displaying errors
-            return [[0, 0, message] for message in self.table]
+        Objects shared between tables are counted only once, in the first
+        table they appear in.
+        '''
+        seen = set()
+        def size(obj):
+            if id(obj) in seen:
+                return 0
+            seen.add(id(obj))
+            n = sys.getsizeof(obj)
+            if isinstance(obj, dict):
+                n += sum(size(k) + size(v) for k, v in obj.items())
+            elif isinstance(obj, (list, tuple, set, frozenset)):
+                n += sum(size(x) for x in obj)
+            elif isinstance(obj, UniEmojiChar):
+                n += sum(size(getattr(obj, attr)) for attr in UniEmojiChar.__slots__)
+            return n
+
+        return {attr: size(value) for attr, value in vars(self).items()
+                if attr not in self._STATE_ATTRS}
+
+    def _filter(self, query, limit=100, pool=None, deadline=None, cancelled=None):
+        '''Finds the names matching query.
+
+        Returns the sorted matches, and the pool of names that could match
+        any query narrowing this one (see _narrows). Passing that pool back
+        in for such a query restricts the search to it.
+
+        Matches that only find characters already found by better matches
+        are left out, so up to `limit` matches finding distinct characters
+        are returned.
+
+        Once the deadline (a time.monotonic() value) passes, the fuzzy
+        search stops and the best matches found so far are returned.
+        SearchCancelled is raised as soon as cancelled() returns True.
+
+        If there's a usage store, the score of every match is raised by the
+        usage bonus of its characters, so that within each match type, the
+        characters picked often or recently come first.
+
+        The custom entries are searched along with the built-in tables, and
+        replace the built-in entries of the same name.
+
+        With a vector_index, the built-in names are matched with NumPy, and
+        only the fuzzy search candidates are checked one by one. The results
+        are the same. The pool is then a pair of a mask of VectorIndex
+        positions, for the built-in names, and a set of names, for the custom
+        entries.
+        '''
+        stats = self.stats
+        if stats is not None:
+            step_start = time.perf_counter()
 
         candidates = self.table
+        custom = self.custom
+        custom_table = custom.table if custom is not None else {}
+        indexes = (self,) if custom is None else (self, custom)
+        usage = self.usage if self.usage else None
+
+        def usage_bonus(candidate_info, candidate_type):
+            if candidate_type == CANDIDATE_UNICODE:
+                return usage.bonus(candidate_info.unicode_str)
+            return max(usage.bonus(unicode_str) for unicode_str in candidate_info.aliasing)
+
+        def match_sequences(candidate_info, candidate_type):
+            # An alias match stands for several characters
+            if candidate_type == CANDIDATE_UNICODE:
+                return (candidate_info.unicode_str,)
+            return candidate_info.aliasing
 
         # Replace '_' in query with ' ' since that's how emojione names are stored
         query = query.replace('_', ' ')
 
-        query_words = []
-        for w in query.split():
-            escaped_w = re.escape(w)
-            query_words.append((
-                w,
-                re.compile(r'\b' + escaped_w + r'\b'),
-                re.compile(r'\b' + escaped_w),
-            ))
+        query_words = query.split()
 
         # Matches are tuples of the form:
         # (match_type, score, name)
@@ -312,112 +1844,304 @@ class UniEmoji():
         # * 0 - levenshtein distance
         matched = []
 
-        for candidate, candidate_info in candidates.items():
+        # Exact match
+        exact_names = []
+        for index in indexes:
+            exact_names.extend(index.mixed_case_names.get(query, ()))
+            if query in index.table and query.lower() == query:
+                exact_names.append(query)
+        if custom is not None:
+            # Custom entries replacing built-in ones are found in both
+            exact_names = list(dict.fromkeys(exact_names))
+        for candidate in exact_names:
             if len(query) > len(candidate): continue
+            candidate_info = custom_table.get(candidate) or candidates[candidate]
+            if candidate_info.unicode_str:
+                matched.append((20, 0, candidate, CANDIDATE_UNICODE))
+            if candidate_info.aliasing:
+                matched.append((5, 0, candidate, CANDIDATE_ALIAS))
 
-            candidate_lowercase = candidate.lower()
+        # Only names containing at least one of the query words can be substring matches
+        vector = self.vector_index
+        pool_mask = None
+        if vector is not None and pool is not None:
+            pool_mask, pool = pool
+        substring_names = set()
+        for w in set(query_words):
+            # The vector index matches the built-in names separately
+            for index in (indexes if vector is None else indexes[1:]):
+                for word in index._words_containing(w):
+                    substring_names.update(index.word_index[word])
+        substring_names.difference_update(exact_names)
+        if pool is not None:
+            substring_names.intersection_update(pool)
+        new_pool = set(exact_names)
 
-            if query == candidate_lowercase:
-                # Exact match
-                if candidate_info.unicode_str:
-                    matched.append((20, 0, candidate, CANDIDATE_UNICODE))
-                if candidate_info.aliasing:
-                    matched.append((5, 0, candidate, CANDIDATE_ALIAS))
+        for candidate in substring_names:
+            if len(query) > len(candidate): continue
+            new_pool.add(candidate)
+
+            if candidate in custom_table:
+                candidate_info = custom_table[candidate]
+                candidate_lowercase, boundaries = custom.word_boundaries[candidate]
             else:
-                # Substring match
-                word_ixs = []
-                substring_found = False
-                exact_word_match = 0
-                prefix_match = 0
-                for w, exact_regex, prefix_regex in query_words:
-                    ix = candidate_lowercase.find(w)
-                    if ix == -1:
-                        word_ixs.append(100)
-                    else:
-                        substring_found = True
-                        word_ixs.append(ix)
-
-                        # Check if an exact word match or a prefix match
-                        if exact_regex.search(candidate_lowercase):
-                            exact_word_match += 1
-                        elif prefix_regex.search(candidate_lowercase):
-                            prefix_match += 1
-
-                if substring_found and all(ix >= 0 for ix in word_ixs):
-                    # For substrings, the closer to the origin, the better
-                    score = -(float(sum(word_ixs)) / len(word_ixs))
-
-                    # Receive a boost if the substring matches a word or a prefix
-                    score += 20 * exact_word_match + 10 * prefix_match
-
-                    if candidate_info.unicode_str:
-                        matched.append((10, score, candidate, CANDIDATE_UNICODE))
-                    if candidate_info.aliasing:
-                        matched.append((5, score, candidate, CANDIDATE_ALIAS))
+                candidate_info = candidates[candidate]
+                candidate_lowercase, boundaries = self.word_boundaries[candidate]
+
+            # Substring match
+            word_ixs = []
+            word_match_bonus = 0
+            for w in query_words:
+                ix = candidate_lowercase.find(w)
+                if ix == -1:
+                    word_ixs.append(100)
                 else:
-                    # Levenshtein distance
-                    score = 0
-                    if Levenshtein is None:
-                        opcodes = SequenceMatcher(None, query, candidate_lowercase,
-                            autojunk=False).get_opcodes()
-                    else:
-                        opcodes = Levenshtein.opcodes(query, candidate_lowercase)
-                    for (tag, i1, i2, j1, j2) in opcodes:
-                        if tag in ('replace', 'delete'):
-                            score = 0
-                            break
-                        if tag == 'insert':
-                            score -= 1
-                        if tag == 'equal':
-                            score += i2 - i1
-                            # favor word boundaries
-                            if j1 == 0:
-                                score += 2
-                            elif candidate[j1 - 1] == ' ':
-                                score += 1
-                            if j2 == len(candidate):
-                                score += 2
-                            elif [j2] == ' ':
-                                score += 1
-                    if score > 0:
-                        if candidate_info.unicode_str:
-                            matched.append((0, score, candidate, CANDIDATE_UNICODE))
-                        if candidate_info.aliasing:
-                            matched.append((0, score, candidate, CANDIDATE_ALIAS))
+                    word_ixs.append(ix)
+
+                    # Receive a boost if the substring matches a word (20) or a prefix (10)
+                    word_match_bonus += _word_match_bonus(w, candidate_lowercase, boundaries)
+
+            # For substrings, the closer to the origin, the better
+            score = -(float(sum(word_ixs)) / len(word_ixs))
+            score += word_match_bonus
+
+            if candidate_info.unicode_str:
+                matched.append((10, score, candidate, CANDIDATE_UNICODE))
+            if candidate_info.aliasing:
+                matched.append((5, score, candidate, CANDIDATE_ALIAS))
+
+        if usage is not None:
+            matched = [(match_type, score + usage_bonus(custom_table.get(candidate) or candidates[candidate],
+                                                        candidate_type),
+                        candidate, candidate_type)
+                       for match_type, score, candidate, candidate_type in matched]
 
         # The first two fields are sorted in reverse.
         # The third text field is sorted by the length of the string, then alphabetically.
-        matched.sort(key=lambda x: (len(x[2]), x[2]))
-        matched.sort(key=lambda x: (x[0], x[1]), reverse=True)
-        return matched[:limit]
+        ranked = _ranked(matched)
+        if vector is not None:
+            substring_mask, scores = vector.substring_scores(query_words)
+            # Exact matches and the names replaced by custom entries were handled above
+            exact_positions = [vector.position(name) for name in exact_names]
+            exact_positions = [position for position in exact_positions if position is not None]
+            excluded = [vector.position(name) for name in custom_table]
+            excluded = exact_positions + [position for position in excluded if position is not None]
+            candidates_mask = substring_mask & (vector.lengths >= len(query))
+            candidates_mask[excluded] = False
+            if pool_mask is not None:
+                candidates_mask &= pool_mask
+            ranked = heapq.merge(ranked, vector.ranked_matches(candidates_mask, scores, usage), key=_match_sort_key)
 
-    def find_characters(self, query_string):
-        results = []
-        candidate_strings = set()
+        # Several names can stand for the same character: only keep the
+        # matches finding a character that no better match found, so that up
+        # to `limit` distinct characters are found
+        seen_sequences = set()
+        matched = []
+        for match in ranked:
+            if len(matched) >= limit: break
+            candidate = match[2]
+            sequences = match_sequences(custom_table.get(candidate) or candidates[candidate], match[3])
+            if seen_sequences.issuperset(sequences): continue
+            seen_sequences.update(sequences)
+            matched.append(match)
+        if stats is not None:
+            now = time.perf_counter()
+            stats.time('substring', now - step_start)
+            stats.count('substring_names', len(substring_names) + len(exact_names) +
+                        (int(substring_mask.sum()) if vector is not None else 0))
+            step_start = now
 
-        def append_result(sequence, description):
-            display = '{}: {}'.format(sequence, description)
-            results.append((sequence, display))
-            if sequence.endswith('\ufe0f'):
-                text_repr = self.has_text_representation.get(sequence)
-                if text_repr:
-                    display = '{}: {} (text)'.format(text_repr, description)
-                    results.append((text_repr, display))
+        # Everything else is left for the fuzzy search
+        interrupted = _interruption_check(deadline, cancelled)
+        exclude = substring_names.union(exact_names)
+        if vector is not None:
+            substring_mask[excluded] = True
+            if pool_mask is not None:
+                substring_mask |= ~pool_mask
+            # The built-in names of the new pool
+            new_pool_mask = candidates_mask.copy()
+            new_pool_mask[exact_positions] = True
+            fuzzy_names, complete = vector.fuzzy_prefilter(query, substring_mask, interrupted=interrupted,
+                                                           found=new_pool_mask)
+        elif custom is None:
+            fuzzy_names, complete = self._fuzzy_prefilter(query, pool, exclude, interrupted=interrupted)
+        else:
+            fuzzy_names, complete = self._fuzzy_prefilter(
+                query, pool, exclude.union(custom_table), interrupted=interrupted)
+        if complete and custom is not None:
+            custom_fuzzy_names, complete = custom._fuzzy_prefilter(query, pool, exclude, interrupted=interrupted)
+            fuzzy_names = list(heapq.merge(fuzzy_names, custom_fuzzy_names,
+                                           key=lambda item: (len(item[0]), item[0])))
+        if complete and vector is None:
+            new_pool.update(candidate for candidate, _ in fuzzy_names)
+        elif complete:
+            # The set only needs the custom names
+            if custom is not None:
+                new_pool.update(candidate for candidate, _ in custom_fuzzy_names)
+            new_pool = (new_pool_mask, new_pool)
+        else:
+            new_pool = None
+        if self.fuzzy_candidate_limit is not None:
+            fuzzy_names = fuzzy_names[:self.fuzzy_candidate_limit]
+        if stats is not None:
+            now = time.perf_counter()
+            stats.time('fuzzy_prefilter', now - step_start)
+            stats.count('fuzzy_names', len(fuzzy_names))
+            step_start = now
 
+        # Fuzzy matches rank below all others, so they only fill the remaining slots.
+        # Candidates come shortest first, so a later candidate only beats an
+        # earlier one with a strictly higher score.
+        # The score is at most the query length, plus 2 for a match at the start
+        # of the name and 2 for a match at its end: any other word boundary
+        # bonus comes with an insertion that costs as much.
+        # With usage, that bound is raised by the largest bonus.
+        fuzzy_slots = limit - len(matched)
+        max_bonus = usage.max_bonus() if usage is not None else 0
+        max_score = len(query) + 4 + max_bonus
+        # Heap of (score, -index, -candidate type, match), smallest is the worst
+        fuzzy_matched = []
+        # The best item of the heap for each character, and the number of
+        # characters each item of the heap is the best one for. An item that
+        # isn't the best one for any character finds nothing new, so it's
+        # dropped from the heap to leave its slot to another character.
+        fuzzy_sequences = {}
+        fuzzy_owned = {}
 
-        if not query_string:
+        def item_sequences(item):
+            _, _, candidate, candidate_type = item[-1]
+            return match_sequences(custom_table.get(candidate) or candidates[candidate], candidate_type)
+
+        for index, (candidate, candidate_lowercase) in enumerate(fuzzy_names):
+            if fuzzy_slots <= 0: break
+            if len(fuzzy_matched) >= fuzzy_slots and fuzzy_matched[0][0] >= max_score: break
+            if interrupted is not None and not index & 31 and interrupted(): break
+
+            score = _fuzzy_score(query, candidate, candidate_lowercase)
+            if score <= 0: continue
+            if len(fuzzy_matched) >= fuzzy_slots and score + max_bonus <= fuzzy_matched[0][0]: continue
+
+            candidate_info = custom_table.get(candidate) or candidates[candidate]
+            for candidate_type, applies in ((CANDIDATE_UNICODE, candidate_info.unicode_str),
+                                            (CANDIDATE_ALIAS, candidate_info.aliasing)):
+                if not applies: continue
+                match_score = score
+                if usage is not None:
+                    match_score += usage_bonus(candidate_info, candidate_type)
+                item = (match_score, -index, -candidate_type, (0, match_score, candidate, candidate_type))
+                sequences = match_sequences(candidate_info, candidate_type)
+                if all(sequence in seen_sequences or fuzzy_sequences.get(sequence, item) > item
+                       for sequence in sequences):
+                    continue
+                if len(fuzzy_matched) >= fuzzy_slots and item < fuzzy_matched[0]:
+                    continue
+                owned = 0
+                dropped = False
+                for sequence in sequences:
+                    if sequence in seen_sequences: continue
+                    previous = fuzzy_sequences.get(sequence)
+                    if previous is not None and previous >= item: continue
+                    fuzzy_sequences[sequence] = item
+                    owned += 1
+                    if previous is not None:
+                        fuzzy_owned[previous] -= 1
+                        if not fuzzy_owned[previous]:
+                            del fuzzy_owned[previous]
+                            dropped = True
+                if dropped:
+                    fuzzy_matched = [other for other in fuzzy_matched if other in fuzzy_owned]
+                    heapq.heapify(fuzzy_matched)
+                fuzzy_owned[item] = owned
+                heapq.heappush(fuzzy_matched, item)
+                if len(fuzzy_matched) > fuzzy_slots:
+                    evicted = heapq.heappop(fuzzy_matched)
+                    del fuzzy_owned[evicted]
+                    for sequence in item_sequences(evicted):
+                        if fuzzy_sequences.get(sequence) is evicted:
+                            del fuzzy_sequences[sequence]
+
+        fuzzy_matched.sort(reverse=True)
+        matched.extend(item[-1] for item in fuzzy_matched)
+        if stats is not None:
+            stats.time('fuzzy', time.perf_counter() - step_start)
+            stats.count('fuzzy_matches', len(fuzzy_matched))
+        return matched, new_pool
+
+    @staticmethod
+    def _narrows(query, new_query):
+        '''Whether every name matching new_query also matches query.
+
+        This holds when new_query extends query, and each of its words
+        contains one of query's words, as a name matches when it contains any
+        of the words.
+        '''
+        query_words = query.split()
+        return (new_query.startswith(query) and bool(query_words) and
+                all(any(w in new_w for w in query_words) for new_w in new_query.split()))
+
+    def new_session(self):
+        return UniEmojiSession(self)
+
+    def find_characters(self, query_string, deadline=None, cancelled=None):
+        '''Returns (character sequence, display string) pairs for query_string.
+
+        They're returned as a SearchResults, which formats the display strings
+        when they're accessed.
+
+        See _filter for deadline and cancelled. Complete results are kept in
+        result_cache.
+        '''
+        with self._lock:
+            results = self._cached_results(query_string)
+            if results is None:
+                results = self._find_characters_locked(query_string, None, deadline, cancelled)[0]
+                if deadline is None or time.monotonic() <= deadline:
+                    self._cache_results(query_string, results)
             return results
 
+    def _result_cache_key(self, query_string):
+        # Only an ASCII alias match depends on the query as typed; the two
+        # kinds of key are kept apart, as '(y)' and '(Y)' normalize alike
+        if query_string in self.ascii_table:
+            return ('ascii', query_string)
+        return ('name', query_string.lower().replace('_', ' '))
+
+    def _result_cache_state(self):
+        # The tables and the usage data the results were computed from
+        return (self.generation, self.usage.version if self.usage else None)
+
+    def _cached_results(self, query_string):
+        return self.result_cache.get(self._result_cache_key(query_string), self._result_cache_state())
+
+    def _cache_results(self, query_string, results):
+        self.result_cache.put(self._result_cache_key(query_string), self._result_cache_state(), results)
+
+    def _find_characters(self, query_string, pool=None, deadline=None, cancelled=None):
+        with self._lock:
+            return self._find_characters_locked(query_string, pool, deadline, cancelled)
+
+    def _find_characters_locked(self, query_string, pool, deadline, cancelled):
+        results = SearchResults(self.unicode_chars_to_names, self.unicode_chars_to_shortnames,
+                                self.has_text_representation)
+        candidate_strings = set()
+
+        if not query_string:
+            return results, None
+
         # Look for an ASCII alias that matches exactly
         ascii_match = self.ascii_table.get(query_string)
         if ascii_match:
             unicode_name = self.reverse_ascii_table[ascii_match]
-            display_str = '{} [{}]'.format(unicode_name, query_string)
-            append_result(ascii_match, display_str)
+            results.append(ascii_match, DESCRIBE_ASCII, unicode_name, query_string)
 
         # Look for a fuzzy match against a description
-        for level, score, name, candidate_type in self._filter(query_string.lower()):
-            uniemoji_char = self.table[name]
+        matched, pool = self._filter(query_string.lower(), pool=pool,
+                                     deadline=deadline, cancelled=cancelled)
+        if self.stats is not None:
+            display_start = time.perf_counter()
+        custom_table = self.custom.table if self.custom is not None else {}
+        for level, score, name, candidate_type in matched:
+            uniemoji_char = custom_table.get(name) or self.table[name]
 
             # Since we have several sources (UnicodeData.txt, EmojiOne),
             # make sure we don't output multiple identical candidates
@@ -425,44 +2149,414 @@ class UniEmoji():
                 if uniemoji_char.unicode_str in candidate_strings:
                     continue
                 candidate_strings.add(uniemoji_char.unicode_str)
-
-                display_str = None
-                if uniemoji_char.is_emojione:
-                    unicode_name = self.unicode_chars_to_names.get(uniemoji_char.unicode_str)
-                    if unicode_name and unicode_name != name:
-                        display_str = ':{}: {}'.format(
-                            name.replace(' ', '_'),
-                            unicode_name)
-                if display_str is None:
-                    shortname = self.unicode_chars_to_shortnames.get(uniemoji_char.unicode_str, '')
-                    if shortname:
-                        shortname = ':' + shortname + ': '
-                    display_str = '{}{}'.format(
-                        shortname,
-                        name)
-
-                append_result(uniemoji_char.unicode_str, display_str)
+                results.append(uniemoji_char.unicode_str, DESCRIBE_NAME, name, uniemoji_char.is_emojione)
 
             # Aliases expand into several candidates
             for unicode_str in uniemoji_char.aliasing:
                 if unicode_str in candidate_strings:
                     continue
                 candidate_strings.add(unicode_str)
-                unicode_name = self.unicode_chars_to_names.get(unicode_str)
-                shortname = self.unicode_chars_to_shortnames.get(unicode_str, '')
-                if shortname:
-                    shortname = ':' + shortname + ': '
-                display_str = '{}{} [{}]'.format(
-                    shortname,
-                    unicode_name,
-                    name)
-                append_result(unicode_str, display_str)
+                results.append(unicode_str, DESCRIBE_ALIAS, name)
+
+        if self.stats is not None:
+            self.stats.time('display', time.perf_counter() - display_start)
+            self.stats.count('results', len(results))
+        return results, pool
+
+
+class UniEmojiSession():
+    '''Search state for a single query being typed.
+
+    Results are remembered for every query on the current typing path, so
+    deleting a character returns a previous result as is, while appending
+    one only searches the names that could still match.
+    '''
+    def __init__(self, uniemoji):
+        self.uniemoji = uniemoji
+        self.generation = uniemoji.generation
+        # List of (query_string, filter query, results, pool)
+        self.history = []
 
+    def reset(self):
+        self.history = []
+
+    def find_characters(self, query_string, deadline=None, cancelled=None):
+        with self.uniemoji._lock:
+            if self.generation != self.uniemoji.generation:
+                # The tables were replaced, so none of the remembered results apply
+                self.generation = self.uniemoji.generation
+                self.reset()
+            return self._find_characters(query_string, deadline, cancelled)
+
+    def _find_characters(self, query_string, deadline, cancelled):
+        for entry in self.history:
+            if entry[0] == query_string:
+                return entry[2]
+
+        # Forget queries that were abandoned by deleting characters
+        self.history = [entry for entry in self.history if query_string.startswith(entry[0])]
+
+        filter_query = query_string.lower().replace('_', ' ')
+        results = self.uniemoji._cached_results(query_string)
+        if results is not None:
+            # Without a pool, the next query searches every name again
+            self.history.append((query_string, filter_query, results, None))
+            return results
+
+        pool = None
+        for _, previous_query, _, previous_pool in reversed(self.history):
+            if previous_pool is not None and UniEmoji._narrows(previous_query, filter_query):
+                pool = previous_pool
+                break
+
+        results, pool = self.uniemoji._find_characters(
+            query_string, pool=pool, deadline=deadline, cancelled=cancelled)
+        if deadline is None or time.monotonic() <= deadline:
+            self.history.append((query_string, filter_query, results, pool))
+            self.uniemoji._cache_results(query_string, results)
         return results
 
+class UsageStore(object):
+    '''How often and how recently each character sequence was picked.
+
+    Every pick is appended to a log file in DATA_DIR, as a line of
+    timestamp, weight and sequence, the sequence as a JSON string since
+    custom entries can contain any character. The log is compacted into
+    one line per sequence once it grows to twice that. Loading and writing
+    are done by a background thread, so recording a pick never waits for
+    the disk.
+
+    A pick's weight halves every HALF_LIFE seconds. The bonus of a sequence
+    adds its decayed number of picks to a recency term, which halves every
+    RECENCY_HALF_LIFE seconds.
+    '''
+    HALF_LIFE = 30 * 24 * 3600
+    RECENCY_HALF_LIFE = 24 * 3600
+    # Score bonus per decayed pick, and the largest bonus
+    BONUS = 10
+    MAX_BONUS = 40
+    # Sequences whose weight fell below this are dropped when compacting
+    MIN_WEIGHT = 0.01
+
+    def __init__(self, filename=None):
+        self.filename = filename or os.path.join(DATA_DIR, USAGE_FILENAME)
+        # sequence -> (weight at last_used, last_used)
+        self.entries = {}
+        # Incremented on every change
+        self.version = 0
+        self.loaded = threading.Event()
+        self._lock = threading.Lock()
+        self._log_lines = 0
+        self._writes = queue.Queue()
+        threading.Thread(target=self._writer, daemon=True).start()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _add(self, sequence, weight, timestamp):
+        with self._lock:
+            old = self.entries.get(sequence)
+            if old is not None:
+                old_weight, old_timestamp = old
+                if timestamp >= old_timestamp:
+                    weight += old_weight * self._decay(timestamp - old_timestamp, self.HALF_LIFE)
+                else:
+                    weight = old_weight + weight * self._decay(old_timestamp - timestamp, self.HALF_LIFE)
+                    timestamp = old_timestamp
+            self.entries[sequence] = (weight, timestamp)
+            self.version += 1
+
+    @staticmethod
+    def _decay(age, half_life):
+        return 0.5 ** (max(age, 0) / half_life)
+
+    def record(self, sequence, timestamp=None):
+        '''Records that sequence was picked.'''
+        if timestamp is None:
+            timestamp = time.time()
+        self._add(sequence, 1, timestamp)
+        self._writes.put((sequence, 1, timestamp))
+
+    def bonus(self, sequence, now=None):
+        entry = self.entries.get(sequence)
+        if entry is None:
+            return 0
+        weight, timestamp = entry
+        age = (time.time() if now is None else now) - timestamp
+        score = weight * self._decay(age, self.HALF_LIFE) + self._decay(age, self.RECENCY_HALF_LIFE)
+        return min(self.BONUS * score, self.MAX_BONUS)
+
+    def max_bonus(self):
+        return self.MAX_BONUS if self.entries else 0
+
+    def flush(self):
+        '''Waits until every recorded pick is written.'''
+        self._writes.join()
+
+    def _writer(self):
+        self._load()
+        self.loaded.set()
+        while True:
+            entry = self._writes.get()
+            try:
+                self._append(*entry)
+                if self._log_lines >= 2 * len(self.entries) + 100:
+                    self._compact()
+            except OSError:
+                debug('Failed to write usage log {}: {}'.format(self.filename, sys.exc_info()[1]))
+            finally:
+                self._writes.task_done()
+
+    def _load(self):
+        try:
+            with open(self.filename, encoding='utf-8') as f:
+                for line in f:
+                    self._log_lines += 1
+                    try:
+                        timestamp, weight, sequence = line.rstrip('\n').split('\t', 2)
+                        sequence = json.loads(sequence)
+                        if not isinstance(sequence, str):
+                            continue
+                        self._add(sequence, float(weight), float(timestamp))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+        except (OSError, UnicodeDecodeError):
+            debug('Failed to load usage log {}: {}'.format(self.filename, sys.exc_info()[1]))
+
+    @staticmethod
+    def _log_line(sequence, weight, timestamp):
+        return '{:.0f}\t{:g}\t{}\n'.format(timestamp, weight, json.dumps(sequence))
+
+    def _append(self, sequence, weight, timestamp):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with open(self.filename, 'a', encoding='utf-8') as f:
+            f.write(self._log_line(sequence, weight, timestamp))
+        self._log_lines += 1
+
+    def _compact(self):
+        with self._lock:
+            entries = [(sequence, weight, timestamp) for sequence, (weight, timestamp) in self.entries.items()]
+        now = time.time()
+        directory = os.path.dirname(self.filename)
+        fd, temp_filename = tempfile.mkstemp(dir=directory, prefix='.usage-')
+        try:
+            lines = 0
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                for sequence, weight, timestamp in entries:
+                    if weight * self._decay(now - timestamp, self.HALF_LIFE) < self.MIN_WEIGHT:
+                        continue
+                    f.write(self._log_line(sequence, weight, timestamp))
+                    lines += 1
+            os.replace(temp_filename, self.filename)
+        except BaseException:
+            os.unlink(temp_filename)
+            raise
+        self._log_lines = lines
+
+# Query server
+#
+# The protocol is line-delimited JSON over a Unix domain socket. Each
+# request is an object with a "query" string, and is answered by an object
+# with "results", a list of [unicode_str, display_str] pairs, or with
+# "error". A client may send any number of requests on one connection.
+
+class _QueryHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                query_string = request['query']
+                if not isinstance(query_string, str):
+                    raise TypeError('query must be a string')
+            except (ValueError, KeyError, TypeError) as e:
+                response = {'error': 'Invalid request: {}'.format(e)}
+            else:
+                results = self.server.uniemoji.find_characters(query_string)
+                response = {'results': [list(result) for result in results]}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+class UniEmojiServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''Answers queries from concurrent clients, using one loaded UniEmoji.'''
+
+    daemon_threads = True
+    # Scripts may start many clients at once
+    request_queue_size = socket.SOMAXCONN
+
+    def __init__(self, socket_path, uniemoji):
+        self.uniemoji = uniemoji
+        self.socket_path = socket_path
+        socketserver.UnixStreamServer.__init__(self, socket_path, _QueryHandler)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+def _remove_stale_socket(socket_path):
+    '''Removes a socket left behind by a server that has exited.
+
+    Raises OSError if a server is still listening on it, or if it's not a
+    socket, so that no other file is removed.
+    '''
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise OSError('{} exists and is not a socket'.format(socket_path))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except FileNotFoundError:
+        return
+    except ConnectionRefusedError:
+        os.unlink(socket_path)
+        return
+    finally:
+        sock.close()
+    raise OSError('A server is already listening on {}'.format(socket_path))
+
+def serve(socket_path=SOCKET_PATH):
+    '''Loads the tables and answers queries on socket_path until interrupted.'''
+    os.makedirs(os.path.dirname(socket_path) or '.', exist_ok=True)
+    _remove_stale_socket(socket_path)
+    # Queries can be answered while the rest of the data is loading
+    ue = UniEmoji(lazy=True)
+    ue.watch_custom_files()
+    old_umask = os.umask(0o077)
+    try:
+        server = UniEmojiServer(socket_path, ue)
+    finally:
+        os.umask(old_umask)
+    debug('Listening on {}'.format(socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def query_server(query_string, socket_path=SOCKET_PATH, timeout=10):
+    '''Sends a query to a running server, and returns the results.
+
+    Raises OSError if no server is listening on socket_path.
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    with sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps({'query': query_string}).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError('The server closed the connection')
+    response = json.loads(line.decode('utf-8'))
+    if 'error' in response:
+        raise ValueError(response['error'])
+    return [tuple(result) for result in response['results']]
+
+# Batch queries
+
+# The tables used by the batch worker processes, inherited when they're forked
+_batch_uniemoji = None
+
+def _batch_find(query_string):
+    # Formatted here, as the results are sent back without their tables
+    return query_string, list(_batch_uniemoji.find_characters(query_string))
+
+def find_characters_batch(ue, queries, jobs=1):
+    '''Yields (query_string, results) for every query, in order.
+
+    With jobs > 1, the queries are spread over that many forked processes,
+    which share ue's tables with this one instead of loading their own.
+    '''
+    global _batch_uniemoji
+    if jobs <= 1:
+        for query_string in queries:
+            yield query_string, ue.find_characters(query_string)
+        return
+
+    ue.wait_until_loaded()
+    _batch_uniemoji = ue
+    try:
+        with multiprocessing.get_context('fork').Pool(jobs) as pool:
+            yield from pool.imap(_batch_find, queries, chunksize=16)
+    finally:
+        _batch_uniemoji = None
+
 if __name__ == '__main__':
-    query_string = ' '.join(sys.argv[1:])
-    ue = UniEmoji()
-    results = ue.find_characters(query_string)
+    import argparse
+    parser = argparse.ArgumentParser(description='Find unicode emoji and symbols by name.')
+    parser.add_argument('query', nargs='*', help='the name to search for')
+    parser.add_argument('--write-index', metavar='FILE',
+                        help='write a memory-mapped index of the data files to FILE, to be shared by '
+                             'every engine that has UNIEMOJI_SHARED_INDEX set to FILE; make writes one '
+                             'that is installed with the data files, and used by default')
+    parser.add_argument('--serve', action='store_true',
+                        help='keep the tables loaded, and answer queries on a Unix socket')
+    parser.add_argument('--client', action='store_true',
+                        help='send the query to a running --serve process instead of loading '
+                             'the tables (they are still loaded if no server is running)')
+    parser.add_argument('--socket', metavar='PATH', default=SOCKET_PATH,
+                        help='the socket used by --serve and --client (default: %(default)s)')
+    parser.add_argument('--batch', metavar='FILE',
+                        help='read queries from FILE (- for stdin), one per line, and print the '
+                             'results of each one')
+    parser.add_argument('--format', choices=('jsonl', 'tsv'), default='jsonl',
+                        help='the output format of --batch: a JSON object per query, or a '
+                             'query/character/description line per result (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='the number of processes answering --batch queries (default: %(default)s)')
+    args = parser.parse_args()
+
+    if args.serve:
+        try:
+            serve(args.socket)
+        except OSError as e:
+            sys.exit(str(e))
+        sys.exit()
+
+    if args.write_index:
+        ue = UniEmoji(use_cache=False)
+        write_mapped_index(ue, args.write_index, ue._data_key())
+        sys.exit()
+
+    if args.batch:
+        # Keep stdout for the results
+        with contextlib.redirect_stdout(sys.stderr):
+            ue = UniEmoji()
+        with (sys.stdin if args.batch == '-' else open(args.batch, encoding='utf-8')) as f:
+            queries = (line.rstrip('\r\n') for line in f)
+            count = 0
+            start = time.perf_counter()
+            for query_string, results in find_characters_batch(ue, (q for q in queries if q.strip()), args.jobs):
+                count += 1
+                if args.format == 'tsv':
+                    for unicode_str, display_str in results:
+                        print(query_string, unicode_str, display_str, sep='\t')
+                else:
+                    print(json.dumps({'query': query_string, 'results': [list(result) for result in results]},
+                                     ensure_ascii=False))
+            elapsed = time.perf_counter() - start
+        print('{} queries in {:.2f} s ({:.1f} queries/s)'.format(count, elapsed, count / elapsed if elapsed else 0),
+              file=sys.stderr)
+        sys.exit()
+
+    query_string = ' '.join(args.query)
+    results = None
+    if args.client:
+        try:
+            results = query_server(query_string, args.socket)
+        except OSError as e:
+            debug('Query server not available: {}'.format(e))
+
+    if results is None:
+        results = UniEmoji().find_characters(query_string)
+
     for _, display_str in results:
         print(display_str)